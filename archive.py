@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: Apache-2.0
+import asyncio
+import bisect
+import json
+import os
+import zlib
+from datetime import datetime
+
+# Finished games (and backups) of a channel are appended to <status>.archive as individually compressed records.
+# <status>.archive.idx has one JSON line per record with its offset and length in the archive and some metadata,
+# so any record can be read with a single seek without decompressing anything else.
+# Records are compressed and written from worker threads, one at a time, in the order they were appended.
+
+
+class Archive:
+	def __init__(self, path):
+		self.path = os.path.splitext(path)[0] + '.archive'
+		self.index_path = self.path + '.idx'
+		self._index = None
+		self._by_user = None
+		self._dates = None  # the date of every entry, in the same order as the index
+		self._append_lock = asyncio.Lock()
+
+	@property
+	def index(self):
+		# List of index entries; entry n - 1 belongs to record number n. Loaded on first use.
+		if self._index is None:
+			self._index = []
+			self._by_user = {}
+			self._dates = []
+			if os.path.exists(self.index_path):
+				with open(self.index_path) as idx:
+					for line in idx:
+						try:
+							self._add_to_index(json.loads(line))
+						except ValueError:
+							# An index entry that was cut short by a crash; its record is lost.
+							pass
+		return self._index
+
+	def _add_to_index(self, entry):
+		self._index.append(entry)
+		self._dates.append(entry['date'])
+		for user in {entry['defender'], entry['winner']} - {None}:
+			self._by_user.setdefault(user, []).append(entry['n'])
+
+	def __len__(self):
+		return len(self.index)
+
+	async def append(self, status_json, kind='game', **info):
+		"""
+		Stores a serialized status (see b20qGame.status_as_json) and returns its record number.
+		`kind` is 'game' for finished games and 'backup' for snapshots of a running game.
+		`info` is stored in the index; it has to include `defender` and `winner` (user IDs or None).
+		"""
+		date = datetime.now().isoformat(timespec='seconds')
+		async with self._append_lock:
+			entry = {'n': len(self.index) + 1, 'kind': kind, 'date': date, **info}
+			await asyncio.get_event_loop().run_in_executor(None, self._write, status_json, entry)
+			self._add_to_index(entry)
+		return entry['n']
+
+	def _write(self, status_json, entry):
+		# Runs in a worker thread, one at a time (see append()). Fills in the record's offset and length.
+		record = zlib.compress(status_json.encode())
+		os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+		with open(self.path, 'ab') as f:
+			entry['offset'] = f.tell()
+			entry['length'] = len(record)
+			f.write(record)
+		with open(self.index_path, 'a') as idx:
+			idx.write(json.dumps(entry) + '\n')
+
+	def entry(self, n):
+		# Raises IndexError if there's no such record.
+		if not 1 <= n <= len(self.index):
+			raise IndexError(n)
+		return self.index[n - 1]
+
+	def read(self, n):
+		# Returns the status dict stored as record number n. Raises IndexError if there's no such record.
+		entry = self.entry(n)
+		with open(self.path, 'rb') as f:
+			f.seek(entry['offset'])
+			return json.loads(zlib.decompress(f.read(entry['length'])))
+
+	def games_of(self, user_id):
+		# Record numbers where the user was the defender or the winner.
+		self.index
+		return self._by_user.get(user_id, [])
+
+	def games_on(self, date):
+		# Record numbers from a date given as the start of an ISO date, e.g. '2020-05' or '2020-05-17'.
+		# Records are appended as they happen, so their dates are in order and can be bisected.
+		self.index
+		start = bisect.bisect_left(self._dates, date)
+		end = bisect.bisect_left(self._dates, date + '\x7f', start)
+		return [entry['n'] for entry in self._index[start:end]]
@@ -1,46 +1,137 @@
 # SPDX-License-Identifier: Apache-2.0
+import time
+# Startup is timed from here, so that importing discord.py and everything else is included; see metrics.startup.
+_started = time.perf_counter()
+
 import sys
 import asyncio
 import configparser
+import contextlib
 import json
 import os
-from collections import OrderedDict
+import signal
 from datetime import datetime
-from typing import Awaitable, Optional
+from typing import Awaitable, Callable, NamedTuple, Optional
 
 import discord
 
+import archive
 import commands
-import utils
+import confirmations
+import gamestate
+import helptopics
+import journal
+import metrics
+import moderators
+import names
+import outbox
+import stats
+import status_format
+import users
 
 MAX_MESSAGE_LENGTH = 2000
 MESSAGE_SPLIT_WARNING = '**[Message split due to exceeding the length limit. Formatting may be broken.]**'
 
+STATUS_DIR = 'status'
+# Where versions before per-channel games kept their one game; see b20qGame.adopt_legacy_status().
+LEGACY_STATUS_FILE = 'status.json'
+
+CONFIG_FILE = 'config.cfg'
+
+
+class Settings(NamedTuple):
+	# Typed view of config.cfg. It's never modified; reload_settings() replaces it as a whole.
+	prefix: str  # includes the trailing space if spaceAfterPrefix is set
+	max_questions: int  # -1 for unlimited
+	max_guesses: int  # -1 for unlimited
+	allow_hints: bool
+	warn_mod_only_fail: bool
+	idle_timeout: int
+	save_interval: float
+	snapshot_interval: int
+	metrics_host: str
+	metrics_port: int  # 0 disables the metrics endpoint
+	confirmation_timeout: float
+	member_updates: bool  # request the privileged members intent; only read on startup
+
+
+def read_settings(parser) -> Settings:
+	section = parser['b20q']
+	return Settings(
+		prefix=section['prefix'] + (' ' if section.getboolean('spaceAfterPrefix') else ''),
+		max_questions=section.getint('maxQuestions'),
+		max_guesses=section.getint('maxGuesses'),
+		allow_hints=section.getboolean('allowHints'),
+		warn_mod_only_fail=section.getboolean('warnModOnlyFunctions'),
+		idle_timeout=section.getint('idleTimeout', fallback=3600),
+		save_interval=section.getfloat('saveInterval', fallback=2.0),
+		snapshot_interval=section.getint('snapshotInterval', fallback=256),
+		metrics_host=section.get('metricsHost', fallback='127.0.0.1'),
+		metrics_port=section.getint('metricsPort', fallback=0),
+		confirmation_timeout=section.getfloat('confirmationTimeout', fallback=300.0),
+		member_updates=section.getboolean('memberUpdates', fallback=False)
+	)
+
+
+def _config_mtime():
+	try:
+		return os.stat(CONFIG_FILE).st_mtime_ns
+	except FileNotFoundError:
+		return None
+
+
 config = configparser.ConfigParser()
-config.read('config.cfg')
+config.read(CONFIG_FILE)
+settings = read_settings(config)
+_loaded_mtime = _config_mtime()
+
+
+def reload_settings() -> bool:
+	# Re-reads config.cfg. If it's invalid, the current settings are kept. Returns whether they were replaced.
+	global config, settings, _loaded_mtime
+	_loaded_mtime = _config_mtime()
+	parser = configparser.ConfigParser()
+	try:
+		parser.read(CONFIG_FILE)
+		new_settings = read_settings(parser)
+	except (configparser.Error, KeyError, ValueError) as e:
+		sys.stderr.write(f'Error while reloading {CONFIG_FILE}; keeping the current settings: {e!r}\n')
+		return False
+	config, settings = parser, new_settings
+	sys.stderr.write(f'Reloaded {CONFIG_FILE}.\n')
+	return True
 
 
 def update_config_file():
-	with open('config.cfg') as c:
+	with open(CONFIG_FILE, 'w') as c:
 		config.write(c)
-
-
-class _DiscordUserSerializer(json.JSONEncoder):
-	def default(self, o):
-		if isinstance(o, discord.User) or isinstance(o, discord.Member):
-			return o.id
-		return super().default(o)
+	reload_settings()
 
 
 # Game state
 class b20qGame:
-	def __init__(self):
-		self.status = {}
-		self.channel = None
+	# One instance per (guild, channel); see GameRegistry.
+	def __init__(self, client, channel):
+		self.status = gamestate.GameState()
+		self.channel = channel
+		self.key = GameRegistry.key(channel)
 		self.initialized = False
 		self._start_opened = False
-		self.confirmation_queue = {}
-		self.client = Client20q()
+		self._init_lock = asyncio.Lock()
+		self._hydration = None
+		self._transaction = None  # (status before it, operations) while in transaction()
+		self.confirmations = confirmations.ConfirmationQueue(settings.confirmation_timeout)
+		self.client = client
+		self.journal = journal.Journal(
+			self.status_file, self.status_as_json,
+			settings.save_interval,
+			settings.snapshot_interval,
+			self._stats_writer
+		)
+		self.archive = archive.Archive(self.status_file)
+		self.renderer = status_format.StatusRenderer(self.display_name)
+		self.outbox = outbox.Outbox(channel, MAX_MESSAGE_LENGTH)
+		self.last_active = time.monotonic()
 
 	def __enter__(self):
 		return self
@@ -48,206 +139,305 @@ class b20qGame:
 	def __exit__(self, type, value, traceback):
 		self.save()
 
-	async def ask_for_confirmation(self, user, success_callback: Optional[Awaitable], fail_callback: Optional[Awaitable]):
-		# Raises ValueError if the user is already in the confirmation queue.
-		if user in self.confirmation_queue:
-			raise ValueError(f'{user} is already in the confirmation queue')
-		if success_callback is None:
-			success_callback = utils.noop()
-		if fail_callback is None:
-			fail_callback = utils.noop()
-		self.confirmation_queue[user] = (success_callback, fail_callback)
+	def ask_for_confirmation(
+		self, user, requester, success_callback: Optional[Callable[[], Awaitable]],
+		fail_callback: Optional[Callable[[], Awaitable]]
+	):
+		# The fail callback also runs if the user doesn't answer in time; see confirmations.ConfirmationQueue.
+		# Raises ValueError if the requester is already waiting for the user, or too many requests are pending.
+		self.confirmations.add(user.id, requester.id, success_callback, fail_callback)
 
 	async def send(self, content, *args, **kwargs):
 		# Use this instead of channel.send() to implement custom behavior.
-		try:
-			if len(str(content)) > MAX_MESSAGE_LENGTH:
-				fragments = [content[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(content), MAX_MESSAGE_LENGTH)]
-				parts = [None, MESSAGE_SPLIT_WARNING] * len(fragments)
-				parts[0::2] = fragments
-				parts.pop()
-				for part in parts:
-					await self.channel.send(part, *args, **kwargs)
-			else:
-				await self.channel.send(content, *args, **kwargs)
-		except Exception as e:
-			await self.channel.send(
-				f'An exception occurred when sending this message:\n'
-				f'{str(e)}'
-			)
-			raise
+		# The message is queued and delivered in the background; see outbox.Outbox.
+		content = str(content) if content is not None else None
+		if content is not None and len(content) > MAX_MESSAGE_LENGTH:
+			fragments = [content[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(content), MAX_MESSAGE_LENGTH)]
+			parts = [None, MESSAGE_SPLIT_WARNING] * len(fragments)
+			parts[0::2] = fragments
+			parts.pop()
+			for part in parts:
+				self.outbox.send(part, *args, **kwargs)
+		else:
+			self.outbox.send(content, *args, **kwargs)
+
+	async def react(self, message, emoji):
+		# Use this instead of message.add_reaction(); like send(), it's queued.
+		self.outbox.react(message, emoji)
+
+	def status_as_json(self, journal_seq=None):
+		_status = self.status.to_dict()
+		if journal_seq is not None:
+			_status['journal_seq'] = journal_seq
+		return json.dumps(_status)
+
+	def user(self, user_id):
+		# Returns a user object for an ID from the status without waiting for Discord.
+		# Users that can't be found (yet; see hydrated()) are represented by placeholders.
+		guild = getattr(self.channel, 'guild', None)
+		user = guild.get_member(user_id) if guild is not None else None
+		return user or self.client.user_cache.lookup(self.client, user_id) or users.placeholder(user_id)
+
+	def display_name(self, user_id):
+		return self.client.names.get(
+			self.key[0], user_id,
+			lambda: status_format.display_name(self.user(user_id), getattr(self.channel, 'guild', None))
+		)
 
-	def status_as_json(self):
-		_status = self.status.copy()
-		try:
-			_status['guess_queue'] = {u.id: g for u, g in _status['guess_queue'].items()}
-		except KeyError:
-			pass
-		return json.dumps(_status, cls=_DiscordUserSerializer)
+	def _user_id(self, user):
+		# Users are stored as IDs; remember who they are so that they can be shown after a restart.
+		if user is None:
+			return None
+		self.client.user_cache.remember(user)
+		return user.id
+
+	@property
+	def status_file(self):
+		return os.path.join(STATUS_DIR, '{}-{}.json'.format(*self.key))
 
 	async def initialize_status(self):
+		async with self._init_lock:
+			if self.initialized:
+				return
+			started = time.perf_counter()
+			self.adopt_legacy_status()
+			try:
+				await self.load_status()
+			except FileNotFoundError:
+				pass
+			except (json.JSONDecodeError, KeyError, ValueError) as e:
+				sys.stderr.write(repr(e))
+				sys.stderr.write(f'\nError while loading status from {self.status_file}. The status has been reset.\n')
+				await self.reset_status()
+			metrics.load_duration.observe(time.perf_counter() - started)
+			self.initialized = True
+
+	def adopt_legacy_status(self):
+		# The game in progress when upgrading from a version with only one game is moved to the first channel
+		# that's used afterwards, unless that channel already has a game of its own.
+		if not os.path.exists(LEGACY_STATUS_FILE):
+			return
+		if os.path.exists(self.status_file) or os.path.exists(self.journal.log_path):
+			return
+		os.makedirs(STATUS_DIR, exist_ok=True)
 		try:
-			await self.load_status()
-		except (json.JSONDecodeError, KeyError, ValueError) as e:
-			sys.stderr.write(repr(e))
-			sys.stderr.write('\nError while loading status from JSON. The status has been reset.\n')
-			self.reset_status()
-		self.initialized = True
+			os.replace(LEGACY_STATUS_FILE, self.status_file)
+		except FileNotFoundError:
+			# Another shard process took it first.
+			return
+		sys.stderr.write(f'Moved the game from {LEGACY_STATUS_FILE} to {self.status_file}.\n')
 
 	async def load_status(self):
-		with open('status.json') as s:
-			_status = json.load(s)
-		# Convert all user IDs into user objects. If an ID is not found (except in queued guesses), reset the status.
-		self.status = self.default_status()
-		self.status.update(_status)
-		if self.status['defender'] is not None:
-			self.status['defender'] = await self.client.fetch_user(_status['defender'])
-			if self.status['defender'] is None:
-				sys.stderr.write('Couldn\'t find the defender user from the saved ID. Resetting game status.\n')
-				self.reset_status()
-				return
-		if self.status['winner'] is not None:
-			self.status['winner'] = await self.client.fetch_user(_status['winner'])
-			if self.status['winner'] is None:
-				sys.stderr.write('Couldn\'t find the winner from the saved ID. Resetting game status.\n')
-				self.reset_status()
-				return
-		self.status['guesses'] = []
-		for c, i, g in _status['guesses']:
-			guesser = await self.client.fetch_user(i)
-			if guesser is None:
-				sys.stderr.write(f'Couldn\'t load guess from user ID {i}. Resetting game status.\n')
-				self.reset_status()
-				return
-			self.status['guesses'].append((c, guesser, g))
-		self.status['guess_queue'] = OrderedDict()
-		for i, g in _status['guess_queue'].items():
-			i = int(i)
-			guesser = await self.client.fetch_user(i)
-			if guesser is None:
-				sys.stderr.write(f'Couldn\'t load queued guess from user ID {i}. Removing the guess.\n')
+		# Users who aren't in the client's cache or the user cache are fetched in the background; see hydrated().
+		self.status = self.journal.load()
+		self.renderer.invalidate()
+		missing = [
+			i for i in self.status.user_ids()
+			if i not in self.client.user_cache.records and self.client.get_user(i) is None
+		]
+		if missing:
+			self._hydration = asyncio.ensure_future(self._hydrate(missing))
+		sys.stderr.write(f'Finished loading game status from {self.status_file}.\n')
+
+	async def _hydrate(self, ids):
+		try:
+			resolved = await asyncio.wait_for(self.client.user_cache.resolve(self.client, ids), 20.0)
+		except asyncio.TimeoutError:
+			sys.stderr.write(f'Timed out while fetching users for {self.status_file}.\n')
+			return
+		except Exception as e:
+			# Keep the placeholders; waiting for hydrated() mustn't fail because of this.
+			sys.stderr.write(f'Error while fetching users for {self.status_file}: {e!r}\n')
+			return
+		for i, user in resolved.items():
+			if user is None:
+				sys.stderr.write(f'Couldn\'t find user ID {i} from {self.status_file}.\n')
 			else:
-				self.status['guess_queue'][guesser] = g
-		sys.stderr.write('Finished loading game status from JSON.\n')
-
-	def reset_status(self, write_json=True):
-		with open('status.json') as s:
-			print(
-				f'Resetting status. '
-				f'Status stored in memory:\n'
-				f'{self.status}\n'
-				f'Previous contents of status.json:\n'
-				f'{s.read()}\n'
-				f'Writing to JSON file: {write_json}'
-			)
-		self.status = self.default_status()
+				# Drop the placeholder's name.
+				self.client.names.invalidate(i, self.key[0])
+		self.renderer.invalidate()
+		await self.client.games.save_caches()
+
+	async def hydrated(self):
+		# Waits until every user in the status has been fetched from Discord (or given up on).
+		if self._hydration is not None:
+			await asyncio.shield(self._hydration)
+
+	async def reset_status(self, write_json=True):
+		previous = None
+		if os.path.exists(self.status_file):
+			with open(self.status_file) as s:
+				previous = s.read()
+		print(
+			f'Resetting status of {self.status_file}. '
+			f'Status stored in memory:\n'
+			f'{self.status.to_dict()}\n'
+			f'Previous contents of the status file:\n'
+			f'{previous}\n'
+			f'Writing to JSON file: {write_json}'
+		)
+		self.status = gamestate.GameState()
+		self.renderer.invalidate()
 		if write_json:
-			with open('status.json', 'w+') as s:
-				json.dump(self.status, s)
-
-	@staticmethod
-	def default_status():
-		return {
-			"winner": None,
-			"defender": None,
-			"answers": [],
-			"hints": [],
-			"guesses": [],
-			"guess_queue": OrderedDict()
-		}
+			await self.flush()
 
 	def is_moderator(self, user, guild):
-		with open('mods.json') as mods:
-			return user.id in json.load(mods).get(str(guild.id), [])
+		return self.client.moderators.is_moderator(user, guild)
 
 	def add_moderator(self, user, guild):
-		with open('mods.json') as mods:
-			modlist = json.load(mods)
-		modlist[guild.id] = modlist.get(str(guild.id), [])
-		modlist[guild.id].append(user.id)
-		with open('mods.json', 'w+') as mods:
-			json.dump(modlist, mods)
+		self.client.moderators.add(user, guild)
 
 	def remove_moderator(self, user, guild):
-		with open('mods.json') as mods:
-			modlist = json.load(mods)
-		if str(guild.id) in modlist and user.id in modlist[str(guild.id)]:
-			modlist[str(guild.id)].remove(user.id)
-			with open('mods.json', 'w+') as mods:
-				json.dump(modlist, mods)
+		self.client.moderators.remove(user, guild)
 
 	@property
 	def prefix(self):
-		return config['b20q']['prefix'] + ' ' if config['b20q'].getboolean('spaceAfterPrefix') else ''
+		return settings.prefix
 
 	@property
 	def winner(self):
-		return self.status['winner']
+		return self.user(self.status.winner) if self.status.winner is not None else None
 
 	@winner.setter
 	def winner(self, value):
-		self.status['winner'] = value
+		self._mutate('set', 'winner', self._user_id(value))
 
 	@property
 	def start_open_to_all(self):
-		return (self.winner is None) or self._start_opened
+		return (self.status.winner is None) or self._start_opened
 
 	@property
 	def defender(self):
-		return self.status['defender']
+		return self.user(self.status.defender) if self.status.defender is not None else None
 
 	@defender.setter
 	def defender(self, value):
-		self.status['defender'] = value
+		self._mutate('set', 'defender', self._user_id(value))
 
 	@property
 	def max_questions(self):
-		return config.getint('b20q', 'maxQuestions')
+		return settings.max_questions
 
 	@property
 	def max_guesses(self):
-		return config.getint('b20q', 'maxGuesses')
+		return settings.max_guesses
 
 	@property
 	def allow_hints(self):
-		return config.getboolean('b20q', 'allowHints')
+		return settings.allow_hints
 
 	@property
 	def warn_mod_only_fail(self):
-		return config.getboolean('b20q', 'warnModOnlyFunctions')
+		return settings.warn_mod_only_fail
 
 	@property
 	def answers_left(self) -> int:
 		if self.max_questions == -1:
 			return -1
-		return self.max_questions - len(self.status['answers'])
+		return self.max_questions - len(self.status.answers)
+
+	def _mutate(self, op, *args):
+		# All changes to the status go through here so that they end up in the journal.
+		# The entry is only written if it could be applied.
+		journal.apply(self.status, op, *args)
+		if self._transaction is not None:
+			self._transaction[1].append((op, args))
+		else:
+			self.journal.append(op, *args)
+		self.renderer.mutated(op, *args)
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""
+		Groups changes to the status: they're journaled together when the block ends,
+		or undone if it raises or calls rollback(). Yields the list of operations made so far.
+		The block shouldn't wait for other tasks, since they would see (and could save) the uncommitted changes.
+		"""
+		self._transaction = (self.status.to_dict(), [])
+		try:
+			yield self._transaction[1]
+		except BaseException:
+			self.rollback()
+			raise
+		finally:
+			_, operations = self._transaction
+			self._transaction = None
+			for op, args in operations:
+				self.journal.append(op, *args)
+
+	def rollback(self):
+		# Undoes the changes made so far in the current transaction.
+		saved, operations = self._transaction
+		if operations:
+			self.status = gamestate.GameState.from_dict(saved)
+			self.renderer.invalidate()
+			operations.clear()
 
 	def add_answer(self, correct: bool, answer: str):
-		self.status['answers'].append((correct, answer))
+		self._mutate('answer', correct, answer)
+
+	def add_hint(self, hint: str):
+		self._mutate('hint', hint)
+
+	def edit(self, part: str, index: int, value):
+		# Raises IndexError if there's nothing to edit at that index.
+		self._mutate('edit', part, index, value)
+
+	def delete(self, part: str, index: int):
+		# Raises IndexError if there's nothing to delete at that index.
+		self._mutate('delete', part, index)
 
 	@property
 	def guesses_left(self) -> int:
+		# -1 for unlimited. Never below 0, even if a game has more guesses than the current limit allows.
 		if self.max_guesses == -1:
 			return -1
-		return self.max_guesses - len(self.status['guesses'])
+		return max(self.max_guesses - len(self.status.guesses), 0)
+
+	@property
+	def out_of_guesses(self):
+		return self.max_guesses != -1 and len(self.status.guesses) >= self.max_guesses
 
 	def add_guess(self, correct: bool, user, guess: str):
-		self.status['guesses'].append((correct, user, guess))
+		self._mutate('guess', correct, self._user_id(user), guess)
+		started = self.status.started
+		self.client.stats.guessed(
+			self.key[0], user.id, correct, len(self.status.answers),
+			time.time() - started if started is not None else None
+		)
+
+	def resolve_guesses(self, correct: bool, guessers):
+		# Moves the queued guesses of all guessers to the list of guesses as one journal entry.
+		# Raises KeyError (without changing anything) if one of them has no queued guess.
+		self._mutate('resolve', correct, [self._user_id(user) for user in guessers])
+		started = self.status.started
+		for user in guessers:
+			self.client.stats.guessed(
+				self.key[0], user.id, correct, len(self.status.answers),
+				time.time() - started if started is not None else None
+			)
+
+	def queue_guess(self, user, guess: str):
+		self._mutate('queue', self._user_id(user), guess)
+
+	def unqueue_guess(self, user):
+		self._mutate('unqueue', user.id)
+
+	def clear_guess_queue(self):
+		self._mutate('clear_queue')
 
 	@property
 	def active(self):
-		return (self.defender is not None) and ((self.guesses_left != 0) and (self.winner is None))
+		return (self.status.defender is not None) and (not self.out_of_guesses and (self.status.winner is None))
 
 	async def start(self, defender):
-		self.status = {
-			'winner': None,
-			'defender': defender,
-			'answers': [],
-			'hints': [],
-			'guesses': [],
-			'guess_queue': {}
-		}
-		await self.channel.send(
+		if self.status.defender is not None:
+			# The previous game was never ended (e.g. the guesses ran out); end it now.
+			await self.end()
+		self._mutate('start', self._user_id(defender))
+		self._mutate('set', 'started', time.time())
+		self.client.stats.started(self.key[0], defender.id)
+		await self.send(
 			f'**A new Questions game has been started!** '
 			f'The current defender is {self.defender.mention}.\n'
 			f'You have __{"unlimited" if self.max_questions == -1 else self.max_questions}__ '
@@ -255,17 +445,168 @@ class b20qGame:
 			f'guesses available.'
 		)
 
-	def end(self):
-		self.status['defender'] = None
+	async def end(self):
+		# The game is over as soon as this is called; only writing it to the archive is waited for.
+		archived = self.archive_game()
+		self.client.stats.ended(self.key[0], self.status.defender, self.status.winner)
+		self.defender = None
+		await archived
+
+	def archive_game(self, kind='game'):
+		# Appends the current status to the history of this channel. Returns an awaitable for its number there;
+		# the status is serialized right away, so it may change while the record is written.
+		return self.archive.append(self.status_as_json(), kind, **self._archive_info())
+
+	def _archive_info(self):
+		return {
+			'defender': self.status.defender,
+			'winner': self.status.winner,
+			'answers': len(self.status.answers),
+			'guesses': len(self.status.guesses),
+			'max_questions': self.max_questions,
+			'max_guesses': self.max_guesses
+		}
 
-	def save(self, filename=None, overwrite=True):
-		with open(filename or (
-			'status.json' if overwrite else f'status-{datetime.now().strftime("%Y%m%d-%H%M")}.json'
-		), 'w') as f:
-			f.write(self.status_as_json())
+	def _stats_writer(self):
+		# Stats are changed together with the status, so the guild's stats are written right after the journal entries.
+		stats = self.client.stats
+		taken = stats.take([self.key[0]])
+		return (lambda: stats.write(taken)) if taken else None
+
+	def commit(self):
+		# Called after every successful command. The changes are written in the background shortly after.
+		self.journal.commit()
+
+	async def flush(self):
+		# Writes a snapshot right away without blocking the event loop.
+		await self.journal.flush(snapshot=True)
+
+	def save(self, filename=None):
+		# Synchronous; backups go to the archive through archive_game() instead.
+		if filename is None:
+			self.journal.save()
+		else:
+			os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+			with open(filename, 'w') as f:
+				f.write(self.status_as_json())
+
+	@property
+	def idle(self):
+		# Games waiting on a confirmation are kept in memory (until the requests expire), since callbacks can't be saved.
+		return not len(self.confirmations) and not self.outbox.depth
+
+
+class GameRegistry:
+	# Maps (guild ID, channel ID) to the b20qGame running in that channel.
+	# Games are created and loaded from disk on first use, and saved and dropped after idleTimeout seconds.
+	def __init__(self, client):
+		self.client = client
+		self.games = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.save_all()
+
+	@staticmethod
+	def key(channel):
+		guild = getattr(channel, 'guild', None)
+		return (guild.id if guild is not None else 0, channel.id)
+
+	async def get(self, channel) -> b20qGame:
+		key = self.key(channel)
+		game = self.games.get(key)
+		if game is None:
+			game = self.games[key] = b20qGame(self.client, channel)
+		game.channel = game.outbox.channel = channel
+		game.last_active = time.monotonic()
+		if not game.initialized:
+			await game.initialize_status()
+		return game
+
+	def __iter__(self):
+		return iter(list(self.games.values()))
+
+	def __len__(self):
+		return len(self.games)
+
+	def save_all(self):
+		# Synchronous, for when the event loop has stopped; everything else uses flush_all().
+		for game in self:
+			if game.initialized:
+				game.save()
+		self.client.user_cache.save()
+		self.client.stats.save()
+
+	async def flush_all(self):
+		await asyncio.gather(*(game.flush() for game in self if game.initialized))
+		await self.save_caches()
+
+	async def save_caches(self):
+		# The data is serialized here and written in a worker thread.
+		# Stats aren't included; they're written with the journals (see b20qGame._stats_writer).
+		await asyncio.get_event_loop().run_in_executor(None, self.client.user_cache.write, self.client.user_cache.take())
+
+	async def drain_all(self):
+		# Waits until every queued message has been sent.
+		await asyncio.gather(*(game.outbox.drain() for game in self))
+
+	async def evict_idle(self, timeout):
+		now = time.monotonic()
+		for game in self:
+			if game.initialized and game.idle and now - game.last_active > timeout:
+				last_active = game.last_active
+				await game.flush()
+				# The game may have been used while it was being written.
+				if game.last_active == last_active and game.idle and not game.journal.dirty:
+					del self.games[game.key]
+
+	async def evict_idle_forever(self):
+		while True:
+			await asyncio.sleep(max(settings.idle_timeout // 4, 1))
+			await self.evict_idle(settings.idle_timeout)
+			await self.save_caches()
 
 
 class Client20q(discord.Client):
+	def __init__(self, *args, **kwargs):
+		if settings.member_updates and hasattr(discord, 'Intents'):
+			# Without the members intent, Discord doesn't send the member and user updates that drop changed names
+			# right away (see _name_changed); names are then only refreshed when they fall out of the cache.
+			# It's privileged, so it has to be enabled for the bot as well. Members aren't requested on startup,
+			# since on_ready would wait for every guild's member list.
+			intents = discord.Intents.default()
+			intents.members = True
+			kwargs.setdefault('intents', intents)
+			kwargs.setdefault('chunk_guilds_at_startup', False)
+		super().__init__(*args, **kwargs)
+		self.games = GameRegistry(self)
+		if isinstance(self, discord.AutoShardedClient):
+			# Other processes may be running the other shards, so only use files that belong to this one's guilds.
+			self.moderators = moderators.PartitionedModerators('mods', legacy='mods.json')
+			self.user_cache = users.UserCache(f'users.{"-".join(map(str, self.shard_ids or ["all"]))}.json')
+		else:
+			self.moderators = moderators.ModeratorIndex('mods.json')
+			self.user_cache = users.UserCache('users.json')
+		self.stats = stats.PlayerStats(STATUS_DIR)
+		self.names = names.NameCache()
+		# Leaves room for the mention that help replies start with.
+		self.help_topics = helptopics.HelpTopics('HelpTopics', MAX_MESSAGE_LENGTH - 40)
+		self._evictor = None
+		self._logged_in = None
+		metrics.gauge('b20q_games', 'Games currently held in memory.', lambda: len(self.games))
+		metrics.gauge(
+			'b20q_outbox_depth', 'Messages and reactions waiting to be sent.',
+			lambda: sum(game.outbox.depth for game in self.games)
+		)
+
+	async def login(self, *args, **kwargs):
+		started = time.perf_counter()
+		await super().login(*args, **kwargs)
+		self._logged_in = time.perf_counter()
+		metrics.startup['login'] = self._logged_in - started
+
 	async def on_ready(self):
 		if 'B20Q_UPDATE_MESSAGE' in os.environ:
 			try:
@@ -278,26 +619,92 @@ class Client20q(discord.Client):
 				await message.add_reaction('✅')
 			except Exception as e:
 				sys.stderr.write(f'Error when reading B20Q_UPDATE_MESSAGE: {os.environ["B20Q_UPDATE_MESSAGE"]}\n{e}\n')
-		if not game.initialized:
+		if self._evictor is None:
+			now = time.perf_counter()
+			if self._logged_in is not None:
+				metrics.startup['gateway'] = now - self._logged_in
+			metrics.startup['ready'] = now - _started
+			sys.stderr.write('Ready; startup took ' + ', '.join(f'{p} {t:.2f}s' for p, t in metrics.startup.items()) + '\n')
+			self._evictor = asyncio.ensure_future(self.games.evict_idle_forever())
+			asyncio.ensure_future(self.watch_config())
 			try:
-				await asyncio.wait_for(game.initialize_status(), 20.0)
-			except asyncio.TimeoutError:
-				sys.stderr.write('Timed out while loading status from JSON. WTF?')
-				game.reset_status()
+				asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.reload_config)
+			except (AttributeError, NotImplementedError):
+				# No SIGHUP on Windows; config.cfg is still reloaded when it changes.
+				pass
+			if settings.metrics_port:
+				# Shard processes serve their metrics on metricsPort + their first shard ID.
+				port = settings.metrics_port + min(getattr(self, 'shard_ids', None) or [0])
+				try:
+					await metrics.serve(settings.metrics_host, port)
+				except OSError as e:
+					sys.stderr.write(f'Couldn\'t serve metrics on {settings.metrics_host}:{port}: {e!r}\n')
+
+	def reload_config(self):
+		if reload_settings():
+			for game in self.games:
+				game.journal.save_interval = settings.save_interval
+				game.journal.snapshot_interval = settings.snapshot_interval
+				game.confirmations.timeout = settings.confirmation_timeout
+
+	async def watch_config(self):
+		while True:
+			await asyncio.sleep(5)
+			if _config_mtime() != _loaded_mtime:
+				self.reload_config()
+
+	def _name_changed(self, user_id, guild_id=None):
+		# Only guilds that have shown the name can have it in a rendered status.
+		guild_ids = set(self.names.invalidate(user_id, guild_id))
+		if guild_ids:
+			for game in self.games:
+				if game.key[0] in guild_ids:
+					game.renderer.invalidate('defender', 'guesses', 'queue')
+
+	async def on_member_update(self, before, after):
+		if before.display_name != after.display_name:
+			self._name_changed(after.id, after.guild.id)
+
+	async def on_user_update(self, before, after):
+		if before.display_name != after.display_name or str(before) != str(after):
+			self._name_changed(after.id)
 
 	async def on_message(self, message):
-		if message.author != self.user:
-			if not game.initialized:
-				await message.channel.send('Still initializing. Wait up to 20 seconds and try again.')
-			elif message.content.startswith(game.prefix):
-				print(f'[{message.guild}] {{{message.author}}} > #{message.channel}: {message.content}')
-				game.channel = message.channel
-				await commands.execute_command(message)
+		if message.author != self.user and message.content.startswith(settings.prefix):
+			print(f'[{message.guild}] {{{message.author}}} > #{message.channel}: {message.content}')
+			created = message.created_at
+			now = datetime.now(created.tzinfo) if created.tzinfo else datetime.utcnow()
+			metrics.event_lag.observe((now - created).total_seconds())
+			game = await self.games.get(message.channel)
+			await commands.execute_command(game, message)
+
+
+class ShardedClient20q(Client20q, discord.AutoShardedClient):
+	pass
+
+
+def shard_options():
+	"""
+	Returns the keyword arguments for ShardedClient20q, or None to run unsharded.
+	Sharded mode is enabled by B20Q_SHARD_COUNT: the total number of shards, or 'auto' to use Discord's
+	recommendation. B20Q_SHARD_IDS (comma-separated) limits this process to some of them; see shards.py.
+	"""
+	count = os.environ.get('B20Q_SHARD_COUNT')
+	if not count:
+		return None
+	options = {}
+	if count != 'auto':
+		options['shard_count'] = int(count)
+	if os.environ.get('B20Q_SHARD_IDS'):
+		options['shard_ids'] = [int(i) for i in os.environ['B20Q_SHARD_IDS'].split(',')]
+	return options
 
 
 if __name__ == '__main__':
-	with b20qGame() as game:
+	metrics.startup['import'] = time.perf_counter() - _started
+	sharding = shard_options()
+	client = Client20q() if sharding is None else ShardedClient20q(**sharding)
+	with client.games:
 		with open('token') as token:
 			_token = token.read().strip()
-		commands.game = game
-		asyncio.get_event_loop().run_until_complete(game.client.start(_token))
+		asyncio.get_event_loop().run_until_complete(client.start(_token))
@@ -0,0 +1,2 @@
+# SPDX-License-Identifier: Apache-2.0
+# Offline benchmarks for b20q. Run from the repository root with: python -m benchmarks.run --help
@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: Apache-2.0
+# Lightweight stand-ins for the discord.py objects that b20q touches, so that commands can run without a connection.
+import itertools
+
+import discord
+
+_ids = itertools.count(10 ** 17)
+
+
+def snowflake():
+	return next(_ids)
+
+
+def _user_data(id, name):
+	return {'id': id, 'username': name, 'discriminator': '0', 'avatar': None, 'global_name': None, 'bot': False}
+
+
+class User(discord.User):
+	# A real discord.User without a connection state, so that isinstance checks and serialization still work.
+	__slots__ = ()
+
+	def __init__(self, name, id=None):
+		super().__init__(state=None, data=_user_data(id or snowflake(), name))
+
+
+class Member(User):
+	__slots__ = ('guild', 'nick')
+
+	def __init__(self, name, guild, nick=None, id=None):
+		super().__init__(name, id)
+		self.guild = guild
+		self.nick = nick
+		guild.members[self.id] = self
+
+	@property
+	def display_name(self):
+		return self.nick or self.name
+
+
+class Guild:
+	def __init__(self, name='Guild', id=None):
+		self.id = id or snowflake()
+		self.name = name
+		self.members = {}
+
+	def __str__(self):
+		return self.name
+
+	def get_member(self, id):
+		return self.members.get(id)
+
+
+class TextChannel:
+	def __init__(self, guild, name='general', id=None):
+		self.id = id or snowflake()
+		self.guild = guild
+		self.name = name
+		self.sent = 0
+		self.sent_length = 0
+
+	def __str__(self):
+		return self.name
+
+	async def send(self, content=None, *args, **kwargs):
+		self.sent += 1
+		self.sent_length += len(str(content))
+
+
+class Message:
+	def __init__(self, author, channel, content, mentions=()):
+		self.id = snowflake()
+		self.author = author
+		self.channel = channel
+		self.guild = channel.guild
+		self.content = content
+		self.mentions = list(mentions)
+		self.reactions = []
+
+	async def add_reaction(self, emoji):
+		self.reactions.append(emoji)
+
+	async def remove_reaction(self, emoji, member):
+		pass
+
+
+def make_client(client_class):
+	# Returns a client that resolves users from the fakes created so far instead of asking Discord.
+	class FakeClient(client_class):
+		def __init__(self):
+			try:
+				super().__init__(intents=discord.Intents.none())
+			except AttributeError:
+				# discord.py < 1.5 doesn't have intents.
+				super().__init__()
+			self.directory = {}
+
+		def register(self, *users):
+			for user in users:
+				self.directory[user.id] = user
+
+		def get_user(self, id):
+			return self.directory.get(id)
+
+		async def fetch_user(self, id):
+			return self.directory.get(id)
+
+	return FakeClient()
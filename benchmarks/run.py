@@ -0,0 +1,265 @@
+# SPDX-License-Identifier: Apache-2.0
+"""
+Offline benchmarks: drives commands.execute_command end to end through fake Discord objects
+and times the hot helpers on their own.
+
+	python -m benchmarks.run [-o results.json] [--compare previous.json] [-k name] [--repeat N]
+
+Everything runs in a temporary directory, so no status files in the working directory are touched.
+Results are written as JSON so that runs of different versions can be compared with --compare.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def summarize(samples, unit_count=None):
+	samples = sorted(samples)
+	total = sum(samples)
+	count = unit_count or len(samples)
+	return {
+		'count': count,
+		'total_s': total,
+		'ops_per_s': count / total if total else None,
+		'p50_ms': samples[len(samples) // 2] * 1000,
+		'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+		'max_ms': samples[-1] * 1000
+	}
+
+
+def timed(fn, repeat):
+	samples = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		samples.append(time.perf_counter() - start)
+	return samples
+
+
+class Harness:
+	# One fake guild and channel with a game in it, plus helpers to send commands as fake users.
+	def __init__(self, b20q, commands, fakes):
+		self.b20q = b20q
+		self.commands = commands
+		self.fakes = fakes
+		self.client = fakes.make_client(b20q.Client20q)
+		self.guild = fakes.Guild()
+		self.channel = fakes.TextChannel(self.guild)
+		self.defender = self.member('defender')
+		self.prefix = b20q.settings.prefix
+
+	def member(self, name):
+		member = self.fakes.Member(name, self.guild)
+		self.client.register(member)
+		return member
+
+	async def game(self):
+		return await self.client.games.get(self.channel)
+
+	async def run(self, author, content, mentions=()):
+		# Returns how long the command took.
+		message = self.fakes.Message(author, self.channel, self.prefix + content, mentions)
+		start = time.perf_counter()
+		await self.commands.execute_command(await self.game(), message)
+		return time.perf_counter() - start
+
+	async def start(self):
+		await self.run(self.defender, 'start')
+
+
+async def bench_answers(h, size):
+	await h.start()
+	return [await h.run(h.defender, f'{"yes" if i % 2 else "no"} answer number {i} with **some** _formatting_') for i in range(size)]
+
+
+async def bench_guess_queue(h, size):
+	await h.start()
+	attackers = [h.member(f'attacker {i}') for i in range(size)]
+	samples = [await h.run(a, f'guess guess number {i}') for i, a in enumerate(attackers)]
+	samples += [await h.run(h.defender, 'incorrect', [a]) for a in attackers]
+	return samples
+
+
+async def _fill(h, answers, hints, guesses):
+	await h.start()
+	game = await h.game()
+	attackers = [h.member(f'attacker {i}') for i in range(10)]
+	for i in range(answers):
+		game.add_answer(i % 2 == 0, f'answer number {i}')
+	for i in range(hints):
+		game.add_hint(f'hint number {i}')
+	for i in range(guesses):
+		game.add_guess(False, attackers[i % len(attackers)], f'guess number {i}')
+	for attacker in attackers[:5]:
+		game.queue_guess(attacker, 'a pending guess')
+	return game
+
+
+async def bench_show(h, size):
+	await _fill(h, size, size // 2, size // 2)
+	return [await h.run(h.defender, 'show') for _ in range(200)]
+
+
+async def bench_show_after_mutation(h, size):
+	await _fill(h, size, size // 2, size // 2)
+	samples = []
+	for i in range(100):
+		await h.run(h.defender, f'yes another answer {i}')
+		samples.append(await h.run(h.defender, 'show'))
+	return samples
+
+
+async def bench_save_burst(h, size):
+	await h.start()
+	game = await h.game()
+	attackers = [h.member(f'attacker {i}') for i in range(50)]
+	samples = []
+	for round in range(size // 50):
+		start = time.perf_counter()
+		for i, attacker in enumerate(attackers):
+			await h.run(attacker, f'guess round {round} guess {i}')
+			await h.run(h.defender, 'incorrect', [attacker])
+		await game.flush()
+		samples.append(time.perf_counter() - start)
+	return samples
+
+
+SCENARIOS = {
+	'answers_500': (bench_answers, 500),
+	'guess_queue_200': (bench_guess_queue, 200),
+	'show_huge_transcript': (bench_show, 500),
+	'show_after_mutation': (bench_show_after_mutation, 500),
+	'save_burst_50': (bench_save_burst, 500)
+}
+
+
+def micro_benchmarks(repeat, selected):
+	import gamestate
+	import names
+	import status_format
+	import utils
+	from benchmarks import fakes
+
+	guild = fakes.Guild()
+	users = [fakes.Member(f'user {i}', guild) for i in range(20)]
+	args = (
+		users[0],
+		gamestate.Answers(gamestate.Answer(i % 2 == 0, f'answer number {i}') for i in range(500)),
+		-1,
+		gamestate.Hints(gamestate.Hint(f'hint number {i}') for i in range(250)),
+		gamestate.Guesses(gamestate.Guess(False, users[i % 20].id, f'guess number {i}') for i in range(250)),
+		gamestate.GuessQueue(gamestate.QueuedGuess(u.id, 'a pending guess') for u in users[:5]),
+		-1,
+		lambda user_id: status_format.display_name(guild.get_member(user_id), guild)
+	)
+	name_cache = names.NameCache()
+	cached_args = args[:-1] + (lambda user_id: name_cache.get(guild.id, user_id, lambda: args[-1](user_id)),)
+	formatted = status_format.apply(*args)
+	short_text = '**bold** and _italic_ and `code` and ~~struck~~ and ||spoiler||'
+	long_text = short_text * 200
+	micro = {
+		'apply': lambda: status_format.apply(*args),
+		'apply_cached_names': lambda: status_format.apply(*cached_args),
+		'split_collapse_breakpoints': lambda: list(status_format.collapse_breakpoints(
+			status_format.split_breakpoints(formatted), 2000
+		)),
+		'remove_formatting_short': lambda: utils.remove_formatting(short_text),
+		'remove_formatting_long': lambda: utils.remove_formatting(long_text)
+	}
+	return {
+		name: summarize(timed(fn, repeat))
+		for name, fn in micro.items() if selected(name)
+	}
+
+
+async def scenario_benchmarks(selected):
+	import b20q
+	import commands
+	import outbox
+	from benchmarks import fakes
+
+	# Fake channels have no rate limits, and the settings should be the same for every run.
+	outbox.MESSAGE_RATE = outbox.REACTION_RATE = (10 ** 9, 1.0)
+	b20q.settings = b20q.settings._replace(max_questions=-1, max_guesses=-1, save_interval=3600.0)
+	results = {}
+	for name, (scenario, size) in SCENARIOS.items():
+		if not selected(name):
+			continue
+		h = Harness(b20q, commands, fakes)
+		samples = await scenario(h, size)
+		await h.client.games.drain_all()
+		results[name] = summarize(samples)
+		results[name]['messages_sent'] = h.channel.sent
+	return results
+
+
+def git_revision():
+	try:
+		return subprocess.run(
+			['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True
+		).stdout.strip() or None
+	except OSError:
+		return None
+
+
+def compare(results, previous):
+	print(f'\n{"benchmark":<32}{"before p50":>12}{"after p50":>12}{"change":>10}')
+	for name, result in results['results'].items():
+		if name not in previous['results']:
+			continue
+		before, after = previous['results'][name]['p50_ms'], result['p50_ms']
+		change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+		print(f'{name:<32}{before:>10.3f}ms{after:>10.3f}ms{change:>10}')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Run the b20q benchmarks without connecting to Discord.')
+	parser.add_argument('-o', '--output', help='write the results to this JSON file')
+	parser.add_argument('--compare', help='JSON file from a previous run to compare against')
+	parser.add_argument('-k', dest='filter', default='', help='only run benchmarks whose name contains this')
+	parser.add_argument('--repeat', type=int, default=200, help='iterations of each microbenchmark')
+	options = parser.parse_args()
+
+	def selected(name):
+		return options.filter in name
+
+	workdir = tempfile.mkdtemp(prefix='b20q-bench-')
+	try:
+		shutil.copy(os.path.join(ROOT, 'config.cfg'), workdir)
+		shutil.copytree(os.path.join(ROOT, 'HelpTopics'), os.path.join(workdir, 'HelpTopics'))
+		os.chdir(workdir)
+		results = micro_benchmarks(options.repeat, selected)
+		results.update(asyncio.get_event_loop().run_until_complete(scenario_benchmarks(selected)))
+	finally:
+		os.chdir(ROOT)
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	output = {
+		'revision': git_revision(),
+		'python': platform.python_version(),
+		'timestamp': time.time(),
+		'results': results
+	}
+	print(f'{"benchmark":<32}{"ops/s":>12}{"p50":>12}{"p99":>12}')
+	for name, result in results.items():
+		print(f'{name:<32}{result["ops_per_s"] or 0:>12.1f}{result["p50_ms"]:>10.3f}ms{result["p99_ms"]:>10.3f}ms')
+	if options.compare:
+		with open(options.compare) as f:
+			compare(output, json.load(f))
+	if options.output:
+		with open(options.output, 'w') as f:
+			json.dump(output, f, indent='\t')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: Apache-2.0
+"""
+Smoke test: runs every command at least once through the fake Discord objects and fails if any of them raises.
+
+	python -m benchmarks.smoke
+
+Like the benchmarks, it runs in a temporary directory. shutdown, update and profile are left out,
+since they stop the process, run git or take seconds; update's in-place reload is exercised directly.
+Before that, journal replay and compaction are checked against the state they should reproduce.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+
+from benchmarks.run import ROOT, Harness
+
+
+def check_journal():
+	# Each check builds a journal, writes it the way the bot would, and compares what load() returns.
+	import gamestate
+	import journal
+	failures = []
+
+	def new(state):
+		return journal.Journal(
+			os.path.join('status', 'journal.json'),
+			lambda seq: json.dumps(dict(state.to_dict(), journal_seq=seq)),
+			snapshot_interval=5
+		)
+
+	def mutate(state, j, op, *args):
+		journal.apply(state, op, *args)
+		j.append(op, *args)
+
+	def expect(name, state):
+		try:
+			loaded = new(gamestate.GameState()).load().to_dict()
+		except Exception:
+			traceback.print_exc()
+			loaded = None
+		if loaded != state.to_dict():
+			failures.append(name)
+			print(f'FAIL {name}: loaded {loaded}, expected {state.to_dict()}')
+
+	def reset():
+		shutil.rmtree('status', ignore_errors=True)
+		state = gamestate.GameState()
+		return state, new(state)
+
+	# Replay of entries that were never compacted.
+	state, j = reset()
+	mutate(state, j, 'start', 1)
+	mutate(state, j, 'answer', True, 'big')
+	mutate(state, j, 'queue', 2, 'cat')
+	j._write(*j._take(False))
+	j.close()
+	expect('replay', state)
+
+	# Compaction: a snapshot every 5 entries, with the entries after it replayed on top.
+	state, j = reset()
+	mutate(state, j, 'start', 1)
+	for n in range(6):
+		mutate(state, j, 'answer', n % 2 == 0, f'a{n}')
+		j._write(*j._take(False))
+	mutate(state, j, 'queue', 2, 'cat')
+	mutate(state, j, 'resolve', False, [2])
+	j._write(*j._take(False))
+	j.close()
+	with open(j.path) as snapshot:
+		if json.load(snapshot).get('journal_seq') != 5:
+			failures.append('compaction')
+			print('FAIL compaction: no snapshot at seq 5')
+	expect('compaction', state)
+
+	# A crash between appending the journal to .old and removing it leaves the entries in both files.
+	state, j = reset()
+	mutate(state, j, 'start', 1)
+	mutate(state, j, 'answer', True, 'big')
+	mutate(state, j, 'queue', 2, 'cat')
+	mutate(state, j, 'unqueue', 2)
+	j._write(*j._take(False))
+	j.close()
+	shutil.copy(j.log_path, j.old_log_path)
+	expect('duplicate entries', state)
+
+	# A snapshot older than one already written must leave the journal alone.
+	state, j = reset()
+	mutate(state, j, 'start', 1)
+	stale = j._take(True)
+	mutate(state, j, 'answer', True, 'big')
+	j._write(*j._take(True))
+	mutate(state, j, 'answer', False, 'red')
+	j._write(*j._take(False))
+	j._write(*stale)
+	j.close()
+	expect('stale snapshot', state)
+
+	# Writes finishing in the opposite order they were taken in mustn't lose the later entries.
+	state, j = reset()
+	mutate(state, j, 'start', 1)
+	mutate(state, j, 'answer', True, 'a1')
+	first = j._take(True)
+	mutate(state, j, 'answer', True, 'a2')
+	j._write(*j._take(False))
+	j._write(*first)
+	j.close()
+	expect('reordered writes', state)
+
+	shutil.rmtree('status', ignore_errors=True)
+	return failures
+
+
+async def smoke():
+	import b20q
+	import commands
+	import outbox
+	from benchmarks import fakes
+
+	outbox.MESSAGE_RATE = outbox.REACTION_RATE = (10 ** 9, 1.0)
+	h = Harness(b20q, commands, fakes)
+	a, b = h.member('attacker'), h.member('other')
+	h.client.moderators.add(h.defender, h.guild)
+	failures = []
+
+	async def run(author, content, *mentions):
+		try:
+			await h.run(author, content, mentions)
+		except Exception:
+			failures.append(content)
+			print(f'FAIL {content!r}')
+			traceback.print_exc()
+
+	steps = [
+		(h.defender, 'help'), (h.defender, 'help 2'), (h.defender, 'help modcommands'), (h.defender, 'show'),
+		(h.defender, 'status'), (h.defender, 'sample'), (h.defender, 'id'), (h.defender, 'id guild'),
+		(h.defender, 'ismod'), (h.defender, 'mod', a), (h.defender, 'unmod', a), (h.defender, 'metrics'),
+		(h.defender, 'start'), (h.defender, 'yes is it big'), (h.defender, 'no is it red'),
+		(h.defender, 'answer yes is it alive\nhint lives on land\n20q edit answer 1 no small'),
+		(h.defender, 'hint a hint'), (h.defender, 'edit hint 2 another hint'), (h.defender, 'delete hint 2'),
+		(a, 'guess cat'), (b, 'guess dog'), (b, 'unguess'), (b, 'guess owl'), (h.defender, 'show'),
+		(h.defender, 'incorrect', b), (b, 'guess fox'), (h.defender, 'incorrect all'), (a, 'guess cow'),
+		(h.defender, 'correct', a), (a, 'open'), (b, 'start'), (h.defender, 'end'),
+		(h.defender, 'start'), (a, 'start'), (h.defender, 'deny'), (a, 'start'), (h.defender, 'confirm'),
+		(a, 'end'), (h.defender, 'history'), (h.defender, 'leaderboard'), (h.defender, 'stats'),
+		(h.defender, 'stats', a), (h.defender, 'save backup'), (h.defender, 'save here'), (h.defender, 'save'),
+	]
+	for author, content, *mentions in steps:
+		await run(author, content, *mentions)
+
+	# What `update` does when only reloadable modules changed.
+	try:
+		commands._reload(h.client)
+	except Exception:
+		failures.append('_reload')
+		traceback.print_exc()
+	commands = sys.modules['commands']
+	h.commands = commands
+	await run(h.defender, 'show')
+	await run(h.defender, 'sample')
+
+	await h.client.games.drain_all()
+	return failures
+
+
+def main():
+	workdir = tempfile.mkdtemp(prefix='b20q-smoke-')
+	try:
+		shutil.copy(os.path.join(ROOT, 'config.cfg'), workdir)
+		shutil.copytree(os.path.join(ROOT, 'HelpTopics'), os.path.join(workdir, 'HelpTopics'))
+		os.chdir(workdir)
+		failures = check_journal()
+		failures += asyncio.get_event_loop().run_until_complete(smoke())
+	finally:
+		os.chdir(ROOT)
+		shutil.rmtree(workdir, ignore_errors=True)
+	if failures:
+		print(f'{len(failures)} command(s) failed')
+		sys.exit(1)
+	print('All commands ran')
+
+
+if __name__ == '__main__':
+	main()
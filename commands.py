@@ -1,141 +1,246 @@
 # SPDX-License-Identifier: Apache-2.0
 import sys
 import os
+import asyncio
 import functools
-import subprocess
+import importlib
+import re
 import threading
 import time
-from collections import OrderedDict
+
+import discord
 
 import b20q
+import gamestate
+import metrics
+import profiler
 import status_format
 import utils
 
-game: b20q.b20qGame
-
-
-async def execute_command(message):
-	COMMANDS = {
-		'start': start,
-		'show': show, 'sh': show,
-		'status': status, 's': status,
-		'help': help_,
-		'open': open_,
-		'confirm': confirm,
-		'deny': deny,
-
-		'edit': edit, 'e': edit,
-		'delete': delete, 'd': delete,
-		'hint': hint, 'h': hint,
-		'answer': answer, 'yes': answer, 'no': answer,
-		'incorrect': incorrect, 'i': incorrect,
-		'correct': correct, 'c': correct,
-		'end': end,
-
-		'guess': guess, 'g': guess,
-		'unguess': unguess, 'ung': unguess,
-
-		'mod': mod,
-		'unmod': unmod,
-		'ismod': is_mod, 'is mod': is_mod, 'am i mod': is_mod,
-		'sample': sample,
-		'id': id_,
-		'save': save,
-		'shutdown': shutdown, 'off': shutdown,
-		'update': update
-	}
-	content = message.content[len(game.prefix)-1:]
-	if len(content) == 0:
+
+# Commands that can be served while the users of a freshly loaded game are still being fetched from Discord.
+# Everything else waits for b20qGame.hydrated().
+NO_HYDRATION = {'help', 'status', 'guess', 'answer'}
+# Commands that can be combined in one message, one per line; see _execute_batch().
+BATCHABLE = {'answer', 'hint', 'edit', 'delete'}
+
+
+async def execute_command(game: 'b20q.b20qGame', message):
+	lines = [line.split() for line in message.content[len(game.prefix):].split('\n')]
+	tokens = lines[0]
+	if not tokens:
 		return
-	for command, fn in COMMANDS.items():
-		if content.split()[0] == command:
-			await fn(message)
-			break
+	name, fn, args = parse_command(tokens)
+	if fn is None:
+		await game.send(f'{message.author.mention} Unknown command "{tokens[0]}".')
+		return
+	lines = [line for line in lines[1:] if line]
+	if name in BATCHABLE and lines:
+		await _execute_batch(game, message, [(tokens, name, fn, args), *(_parse_line(game, line) for line in lines)])
+		return
+	if name not in NO_HYDRATION:
+		await game.hydrated()
+	await _run_command(game, message, name, fn, args)
+
+
+async def _run_command(game, message, name, fn, args):
+	start = time.perf_counter()
+	try:
+		await fn(game, message, args)
+	except Exception:
+		metrics.command_errors[name] += 1
+		raise
+	finally:
+		metrics.command_latency[name].observe(time.perf_counter() - start)
+
+
+def _parse_line(game, tokens):
+	# Lines after the first one of a batch may leave out the prefix.
+	prefix = game.prefix.split()
+	if tokens[:len(prefix)] == prefix and len(tokens) > len(prefix):
+		tokens = tokens[len(prefix):]
+	return (tokens, *parse_command(tokens))
+
+
+class _Batch:
+	# Stands in for the game while the lines of a batch run, collecting their replies instead of sending them.
+	def __init__(self, game):
+		self.game = game
+		self.replies = []
+		self.reactions = []
+
+	def __getattr__(self, name):
+		return getattr(self.game, name)
+
+	async def send(self, content, *args, **kwargs):
+		if content is not None:
+			self.replies.append(str(content))
+
+	async def react(self, message, emoji):
+		self.reactions.append(emoji)
+
+
+async def _execute_batch(game, message, lines):
+	"""
+	Runs one command per line as a single transaction, e.g. several answers in one message.
+	A line fails if it doesn't change the status. If any line fails, nothing is changed,
+	and the reply lists the failed lines with their errors. Otherwise, the replies of all lines are sent as one message.
+	"""
+	if any(name not in NO_HYDRATION for _, name, _, _ in lines):
+		await game.hydrated()
+	replies, reactions, failures = [], [], []
+	with game.transaction() as changes:
+		for i, (tokens, name, fn, args) in enumerate(lines, 1):
+			if fn is None:
+				failures.append((i, tokens, f'Unknown command "{tokens[0]}".'))
+				continue
+			if name not in BATCHABLE:
+				failures.append((i, tokens, f'_{name}_ can\'t be used in a batch.'))
+				continue
+			batch = _Batch(game)
+			count = len(changes)
+			await _run_command(batch, message, name, fn, args)
+			if len(changes) == count:
+				failures.append((i, tokens, ' '.join(batch.replies).replace(message.author.mention, '').strip() or '❌'))
+			else:
+				replies.extend(batch.replies)
+				reactions.extend(batch.reactions)
+		if failures:
+			game.rollback()
+	if failures:
+		await game.send(
+			f'{message.author.mention} Nothing was changed because '
+			f'{"a line" if len(failures) == 1 else f"{len(failures)} lines"} of the batch failed:\n' + '\n'.join(
+				f'**{i}.** `{" ".join(tokens)}`: {error}' for i, tokens, error in failures
+			)
+		)
+		await game.react(message, '❌')
 	else:
-		await game.send(f'{message.author.mention} Unknown command "{content.split()[0]}".')
+		game.commit()
+		if replies:
+			await game.send('\n'.join(replies))
+		if reactions or not replies:
+			await game.react(message, '✅')
+
+
+def parse_command(tokens):
+	"""
+	Finds the longest command name that the tokens start with.
+	Returns the command's main name, the handler and the arguments to call it with,
+	or (None, None, None) if there's no such command.
+	"""
+	node, name, fn, args = _COMMAND_TRIE, None, None, None
+	for i, token in enumerate(tokens):
+		node = node.get(token)
+		if node is None:
+			break
+		if None in node:
+			name, fn, implicit_args = node[None]
+			args = [*implicit_args, *tokens[i + 1:]]
+	return name, fn, args
+
+
+def _build_command_trie(commands):
+	# Each command name is split into words; the handler is stored under the None key of the last word's node.
+	# The first name listed for a handler is its main name, which is used for metrics.
+	trie = {}
+	names = {}
+	for name, fn in commands.items():
+		fn, implicit_args = fn if isinstance(fn, tuple) else (fn, ())
+		node = trie
+		for token in name.split():
+			node = node.setdefault(token, {})
+		node[None] = (names.setdefault(fn, name), fn, implicit_args)
+	return trie
 
 
 def save_before_execute(co):
 	@functools.wraps(co)
-	async def wrapper(*args, **kwargs):
-		game.save()
-		await co(*args, **kwargs)
+	async def wrapper(game, *args, **kwargs):
+		await game.client.games.flush_all()
+		await co(game, *args, **kwargs)
 	return wrapper
 
 
 def save_on_success(co):
 	"""If the command was successful, it should return True. False or None will be ignored."""
 	@functools.wraps(co)
-	async def wrapper(*args, **kwargs):
-		if await co(*args, **kwargs):
-			game.save()
+	async def wrapper(game, *args, **kwargs):
+		if await co(game, *args, **kwargs):
+			game.commit()
 	return wrapper
 
 
 def active_only(fn):
-	async def wrapper(message):
+	async def wrapper(game, message, args):
 		if game.active:
-			await fn(message)
+			await fn(game, message, args)
 		else:
-			await message.add_reaction('❌')
+			await game.react(message, '❌')
 	return wrapper
 
 
 def mod_only(fn):
-	async def wrapper(message):
+	async def wrapper(game, message, args):
 		if game.is_moderator(message.author, message.guild):
-			await fn(message)
+			await fn(game, message, args)
 		else:
-			await on_mod_only_fail(message)
+			await on_mod_only_fail(game, message)
 	return wrapper
 
 
 def defender_only(fn):
-	async def wrapper(message):
+	async def wrapper(game, message, args):
 		if message.author == game.defender or game.is_moderator(message.author, message.guild):
-			await fn(message)
+			await fn(game, message, args)
 	return wrapper
 
 
 def attacker_only(fn):
-	async def wrapper(message):
+	async def wrapper(game, message, args):
 		if message.author != game.defender:
-			await fn(message)
+			await fn(game, message, args)
 	return wrapper
 
 
 def winner_only(fn):
-	async def wrapper(message):
+	async def wrapper(game, message, args):
 		if message.author == game.winner:
-			await fn(message)
+			await fn(game, message, args)
 	return wrapper
 
 
-async def on_mod_only_fail(message):
+async def on_mod_only_fail(game, message):
 	if game.warn_mod_only_fail:
 		await game.send(f'{message.author.mention} This command can only be used by moderators.')
 
 
-async def confirm(message):
-	if message.author in game.confirmation_queue:
-		await game.confirmation_queue[message.author][0]
-		game.confirmation_queue[message.author][1].cancel()
-		del game.confirmation_queue[message.author]
-	else:
-		await message.add_reaction('❌')
+# With several pending requests, the oldest one is answered unless the requester is mentioned.
+async def _nothing_to_answer(game, message):
+	# If the mentioned user isn't waiting, but others are, say who they are.
+	await game.react(message, '❌')
+	waiting = game.confirmations.requesters(message.author.id)
+	if waiting:
+		await game.send(
+			f'{message.author.mention} Waiting for your answer: {", ".join(f"<@{i}>" for i in waiting)}.',
+			allowed_mentions=discord.AllowedMentions.none()
+		)
 
 
-async def deny(message):
-	if message.author in game.confirmation_queue:
-		await game.confirmation_queue[message.author][1]
-		game.confirmation_queue[message.author][0].cancel()
-		del game.confirmation_queue[message.author]
-	else:
-		await message.add_reaction('❌')
+async def confirm(game, message, args):
+	requester = message.mentions[0].id if message.mentions else None
+	if not await game.confirmations.confirm(message.author.id, requester):
+		await _nothing_to_answer(game, message)
+
+
+async def deny(game, message, args):
+	requester = message.mentions[0].id if message.mentions else None
+	if not await game.confirmations.deny(message.author.id, requester):
+		await _nothing_to_answer(game, message)
 
 
 @winner_only
-async def open_(message):
+async def open_(game, message, args):
 	game._start_opened = True
 	await game.send(
 		f'The winner has opened the game to everyone. '
@@ -144,7 +249,7 @@ async def open_(message):
 
 
 @save_on_success
-async def start(message):
+async def start(game, message, args):
 	if game.active:
 		await game.send(
 			f'A game is already running! The current defender is {game.defender}.\n'
@@ -156,45 +261,62 @@ async def start(message):
 		await game.start(message.author)
 		return True
 	else:
+		requester, winner = message.author, game.winner
+
+		async def confirmed():
+			# Another request may have been confirmed first.
+			if game.active:
+				await game.send(f'{requester.mention} Someone else has started a game in the meantime.')
+			else:
+				await game.start(requester)
+				game.commit()
+
+		async def denied():
+			# Also runs if the winner doesn't answer in time.
+			await game.send(f'{requester.mention} Your request to start the next game wasn\'t accepted by {winner}.')
+
 		try:
-			await game.ask_for_confirmation(game.winner, game.start(message.author), None)
+			game.ask_for_confirmation(winner, requester, confirmed, denied)
 			await game.send(
 				f'You are attempting to start a new game; however, the previous winner takes priority. '
-				f'{game.winner.mention} can give you the OK by sending `{game.prefix}confirm` '
+				f'{winner.mention} can give you the OK by sending `{game.prefix}confirm` '
 				f'or `{game.prefix}deny` otherwise.'
 			)
 		except ValueError:
 			await game.send(
-				f'Someone has already requested the previous winner\'s permission to start the game. '
-				f'Wait until {game.winner.mention} sends `{game.prefix}confirm` or `{game.prefix}deny` and try again.'
+				f'{requester.mention} You have already asked (or too many people are asking) for the previous '
+				f'winner\'s permission to start the game. Wait until {winner.mention} sends `{game.prefix}confirm` '
+				f'or `{game.prefix}deny` and try again.'
 			)
 
 
-async def show(message):
+async def show(game, message, args):
 	await status_format.send(
+		game,
 		game.defender,
-		game.status['answers'],
+		game.status.answers,
 		game.max_questions,
-		game.status['hints'],
-		game.status['guesses'],
-		game.status['guess_queue'].items(),
+		game.status.hints,
+		game.status.guesses,
+		game.status.guess_queue,
 		game.max_guesses
 	)
 
 
-async def status(message):
+async def status(game, message, args):
 	await status_format.send_brief(
+		game,
 		game.defender,
-		game.status['answers'],
+		game.status.answers,
 		game.max_questions,
-		game.status['hints'],
-		game.status['guesses'],
-		game.status['guess_queue'].items(),
+		game.status.hints,
+		game.status.guesses,
+		game.status.guess_queue,
 		game.max_guesses
 	)
 
 
-async def help_(message):
+async def help_(game, message, args):
 	TOPIC_ALIASES = {
 		'': '1',
 		'b20q': '1',
@@ -205,15 +327,15 @@ async def help_(message):
 		'mod': 'modcommands',
 		'mod commands': 'modcommands'
 	}
-	content = message.content.lstrip(game.prefix)
-	topic = ' '.join(content.split()[1:]).lower()
+	topic = ' '.join(args).lower()
 	if topic in TOPIC_ALIASES:
 		topic = TOPIC_ALIASES[topic]
-	if os.path.exists(f'./HelpTopics/{topic}.txt'):
-		with open(f'./HelpTopics/{topic}.txt') as helptxt:
-			text = helptxt.read().replace('%prefix%', game.prefix)
-			if topic != 'modcommands' or game.is_moderator(message.author, message.guild):
-				await game.send(f'{message.author.mention}\n{text}')
+	fragments = game.client.help_topics.get(topic, game.prefix)
+	if fragments is not None:
+		if topic != 'modcommands' or game.is_moderator(message.author, message.guild):
+			await game.send(f'{message.author.mention}\n{fragments[0]}')
+			for fragment in fragments[1:]:
+				await game.send(fragment)
 	elif topic.isdigit():
 		await game.send(f'{message.author.mention} Help page not found.')
 	else:
@@ -223,69 +345,66 @@ async def help_(message):
 @active_only
 @defender_only
 @save_on_success
-async def edit(message):
-	args = [game.prefix] + message.content.lstrip(game.prefix).split('\n')[0].split()
-	if (len(args) < 5) or (args[2] not in ('answer', 'hint')) or (not args[3].isdigit()):
+async def edit(game, message, args):
+	if (len(args) < 3) or (args[0] not in ('answer', 'hint')) or (not args[1].isdigit()):
 		await game.send(f'{message.author.mention} Format: `{game.prefix}edit <answer|hint> <index> <result>`')
 		return False
-	index = int(args[3]) - 1
-	result = utils.remove_formatting(' '.join(args[4:]))
-	if args[2] == 'answer' and (result.startswith('yes ') or result.startswith('no ')):
+	index = int(args[1]) - 1
+	result = utils.remove_formatting(' '.join(args[2:]))
+	if args[0] == 'answer' and (result.startswith('yes ') or result.startswith('no ')):
 		# Editing the yes/no attribute first. Exit if the actual answer wasn't edited.
 		try:
-			game.status['answers'][index] = (result.startswith('yes '), game.status['answers'][index][1])
-			await message.add_reaction('✅')
+			game.edit('answers', index, (result.startswith('yes '), game.status.answers[index].text))
+			await game.react(message, '✅')
 		except IndexError:
-			await message.add_reaction('❌')
+			await game.react(message, '❌')
 			return False
 		result = ' '.join(result.split()[1:])
 		if not result:
 			return True
-	if args[2] == 'answer':
+	if args[0] == 'answer':
 		try:
-			game.status['answers'][index] = (game.status['answers'][index][0], result)
-			await message.add_reaction('✅')
+			game.edit('answers', index, (game.status.answers[index].correct, result))
+			await game.react(message, '✅')
 			return True
 		except IndexError:
-			await message.add_reaction('❌')
+			await game.react(message, '❌')
 			return False
-	elif args[2] == 'hint':
+	elif args[0] == 'hint':
 		try:
-			game.status['hints'][index] = result
-			await message.add_reaction('✅')
+			game.edit('hints', index, result)
+			await game.react(message, '✅')
 			return True
 		except IndexError:
-			await message.add_reaction('❌')
+			await game.react(message, '❌')
 			return False
 
 
 @active_only
 @defender_only
 @save_on_success
-async def delete(message):
-	args = [game.prefix] + message.content.lstrip(game.prefix).split()
-	if (len(args) < 4) or (args[2] not in ('answer', 'hint')) or (not args[3].isdigit()):
+async def delete(game, message, args):
+	if (len(args) < 2) or (args[0] not in ('answer', 'hint')) or (not args[1].isdigit()):
 		await game.send(f'{message.author.mention} Format: `{game.prefix}delete <answer|hint> <index>`')
 		return False
-	part = args[2]
-	index = int(args[3]) - 1
+	part = args[0]
+	index = int(args[1]) - 1
 	try:
-		del game.status[part + 's'][index]
-		await message.add_reaction('✅')
+		game.delete(part + 's', index)
+		await game.react(message, '✅')
 		return True
 	except IndexError:
-		await message.add_reaction('❌')
+		await game.react(message, '❌')
 		return False
 
 
 @active_only
 @defender_only
 @save_on_success
-async def hint(message):
-	content = message.content.split('\n')[0].lstrip(game.prefix)
-	if len(content.split()) > 1:
-		_hint = utils.remove_formatting(' '.join(content.split()[1:]))
-		game.status['hints'].append(_hint)
+async def hint(game, message, args):
+	if args:
+		_hint = utils.remove_formatting(' '.join(args))
+		game.add_hint(_hint)
 		await game.send(f'**New hint:**\n`{_hint or " "}`')
 		return True
 
@@ -293,113 +412,133 @@ async def hint(message):
 @active_only
 @defender_only
 @save_on_success
-async def answer(message):
-	content = message.content.split('\n')[0].lstrip(game.prefix).replace('answer', '', 1).strip()
-	if len(content.split()) < 2 or content.split()[0] not in ('yes', 'no'):
+async def answer(game, message, args):
+	if len(args) < 2 or args[0] not in ('yes', 'no'):
 		await game.send(f'{message.author.mention} Format: {game.prefix}[answer] <yes|no> <answer>')
 	elif game.answers_left == 0:
 		await game.send('There are no questions left.')
 	else:
-		_answer = utils.remove_formatting(' '.join(content.split()[1:]))
-		_correct = content.split()[0] == 'yes'
+		_answer = utils.remove_formatting(' '.join(args[1:]))
+		_correct = args[0] == 'yes'
 		game.add_answer(_correct, _answer)
 		await game.send(f'**New answer:**```diff\n{"+" if _correct else "-"} {_answer or " "}\n```')
 		return True
 
 
-async def _confirm_guess(message):
+async def _confirm_guesses(game, message, args, many=False):
 	"""
 	Used for correct/incorrect guess confirmations.
-	Returns the user whose guess is being confirmed or None if not found.
+	Returns the users whose guesses are being confirmed (in the order they were made), or an empty list.
+	With many=True, every mentioned user is included, and "all" selects the whole queue.
 	"""
-	if len(game.status['guess_queue']) == 0:
+	queue = game.status.guess_queue
+	if len(queue) == 0:
 		await game.send(f'{message.author.mention} There are no active guesses.')
-		return None
+		return []
+	elif many and args and args[0] == 'all':
+		return [game.user(queued.user_id) for queued in queue]
 	elif message.mentions:
-		user = message.mentions[0]
-		if user not in game.status['guess_queue']:
+		users = message.mentions if many else message.mentions[:1]
+		missing = [user for user in users if user.id not in queue]
+		if missing:
+			verb = "hasn't" if len(missing) == 1 else "haven't"
 			await game.send(
-				f'That user hasn\'t made any guesses. '
+				f'{", ".join(str(user) for user in missing)} {verb} made any guesses. '
 				f'Use `{game.prefix}show` to view the guess queue.'
 			)
-			return None
-		else:
-			return user
-	elif len(game.status['guess_queue']) == 1:
-		return list(game.status['guess_queue'].items())[0][0]
+			return []
+		users = list({user.id: user for user in users}.values())
+		order = {queued.user_id: i for i, queued in enumerate(queue)}
+		return sorted(users, key=lambda user: order[user.id])
+	elif len(queue) == 1:
+		return [game.user(queue.first().user_id)]
 	else:
 		await game.send(
 			f'{message.author.mention} There are multiple guesses active. '
-			f'Please choose a user and try again.'
+			f'Please choose a user{" (or all)" if many else ""} and try again.'
 		)
-		return None
+		return []
 
 
 @active_only
 @defender_only
 @save_on_success
-async def correct(message):
-	user = await _confirm_guess(message)
-	if user is None:
+async def correct(game, message, args):
+	users = await _confirm_guesses(game, message, args)
+	if not users:
 		return False
-	game.add_guess(True, user, game.status['guess_queue'][user])
+	user = users[0]
+	game.add_guess(True, user, game.status.guess_queue[user.id])
 	game.winner = user
 	await game.send(
 		f'**Game over!** '
-		f'The winner is: {user.mention}\nThe correct guess was: __{game.status["guesses"][-1][2]}__'
-		f'\n**{len(game.status["answers"])}** questions were asked and '
-		f'**{len(game.status["guesses"])}** guesses were made.\n'
+		f'The winner is: {user.mention}\nThe correct guess was: __{game.status.guesses[-1].text}__'
+		f'\n**{len(game.status.answers)}** questions were asked and '
+		f'**{len(game.status.guesses)}** guesses were made.\n'
 		f'The winner may now start a new game with `{game.prefix}start`, request someone else '
 		f'to be the defender, or wait until someone asks to defend and confirm it.'
 	)
-	game.status['guess_queue'] = OrderedDict()
-	game.end()
+	game.clear_guess_queue()
+	await game.end()
 	return True
 
 
 @active_only
 @defender_only
 @save_on_success
-async def incorrect(message):
-	user = await _confirm_guess(message)
-	if user is None:
+async def incorrect(game, message, args):
+	users = await _confirm_guesses(game, message, args, many=True)
+	if not users:
 		return False
-	game.add_guess(False, user, game.status['guess_queue'][user])
-	await game.send(f'**Incorrect guess:** `{game.status["guess_queue"][user]}`')
-	del game.status['guess_queue'][user]
+	# Only as many guesses as are left are counted, oldest first; the rest stay in the queue.
+	left_over = []
+	if game.guesses_left != -1 and len(users) > game.guesses_left:
+		users, left_over = users[:game.guesses_left], users[game.guesses_left:]
+	guesses = [game.status.guess_queue[user.id] for user in users]
+	game.resolve_guesses(False, users)
+	if len(users) == 1:
+		await game.send(f'**Incorrect guess:** `{guesses[0]}`')
+	else:
+		await game.send('**Incorrect guesses:**\n' + '\n'.join(
+			f'`{guess}` ({game.display_name(user.id)})' for user, guess in zip(users, guesses)
+		))
+	if left_over:
+		await game.send(
+			'There are no guesses left, so these were not counted: ' +
+			', '.join(f'`{game.status.guess_queue[user.id]}` ({game.display_name(user.id)})' for user in left_over)
+		)
 	return True
 
 
 @active_only
 @defender_only
 @save_on_success
-async def end(message):
+async def end(game, message, args):
 	await game.send(
 		f'**The 20 Questions game has been ended by the defender,** {message.author.mention}. '
 		f'Type `{game.prefix}show` to see the results so far or '
 		f'`{game.prefix}start` to start a new game as the defender.'
 	)
-	game.end()
+	await game.end()
 	return True
 
 
 @active_only
 @attacker_only
 @save_on_success
-async def guess(message):
-	content = message.content.split('\n')[0].lstrip(game.prefix)
-	if len(content.split()) < 2:
+async def guess(game, message, args):
+	if not args:
 		await game.send(f'{message.author.mention} Enter the guess after "{game.prefix}guess" and try again.')
-	elif game.guesses_left == 0:
+	elif game.out_of_guesses:
 		await game.send('There are no guesses left.')
-	elif message.author in game.status['guess_queue']:
+	elif message.author.id in game.status.guess_queue:
 		await game.send(
 			f'{message.author.mention} Please wait until your guess "'
-			f'{game.status["guess_queue"][message.author]}" has been confirmed or denied by the defender.'
+			f'{game.status.guess_queue[message.author.id]}" has been confirmed or denied by the defender.'
 		)
 	else:
-		_guess = utils.remove_formatting(' '.join(content.split()[1:]))
-		game.status['guess_queue'][message.author] = _guess
+		_guess = utils.remove_formatting(' '.join(args))
+		game.queue_guess(message.author, _guess)
 		await game.send(
 			f'**New guess:** `{_guess or " "}`\n'
 			f'{game.defender.mention} Use _{game.prefix}<correct|incorrect> [user]_ to confirm or '
@@ -411,39 +550,39 @@ async def guess(message):
 @active_only
 @attacker_only
 @save_on_success
-async def unguess(message):
-	if message.author in game.status['guess_queue']:
-		del game.status['guess_queue'][message.author]
-		await message.add_reaction('✅')
+async def unguess(game, message, args):
+	if message.author.id in game.status.guess_queue:
+		game.unqueue_guess(message.author)
+		await game.react(message, '✅')
 		return True
 	else:
-		await message.add_reaction('❌')
+		await game.react(message, '❌')
 		return False
 
 
 @mod_only
-async def mod(message):
+async def mod(game, message, args):
 	if not message.mentions:
 		await game.send(f'Format: {game.prefix}mod <user mention>')
 	elif game.is_moderator(message.mentions[0], message.guild):
 		await game.send('This user is already a moderator on this server.')
 	else:
 		game.add_moderator(message.mentions[0], message.guild)
-		await message.add_reaction('✅')
+		await game.react(message, '✅')
 
 
 @mod_only
-async def unmod(message):
+async def unmod(game, message, args):
 	if not message.mentions:
 		await game.send(f'Format: {game.prefix}mod <user mention>')
 	elif not game.is_moderator(message.mentions[0], message.guild):
 		await game.send('This user is not a moderator on this server.')
 	else:
 		game.remove_moderator(message.mentions[0], message.guild)
-		await message.add_reaction('✅')
+		await game.react(message, '✅')
 
 
-async def is_mod(message):
+async def is_mod(game, message, args):
 	user = message.author
 	if message.mentions:
 		user = message.mentions[0]
@@ -455,58 +594,277 @@ async def is_mod(message):
 
 
 @mod_only
-async def sample(message):
+async def sample(game, message, args):
+	author = message.author.id
 	await game.send(status_format.apply(
 		message.author,
-		[(False, 'This guess was incorrect.'), (True, 'This guess was correct.'), (True, 'This one too.')],
+		gamestate.Answers([
+			gamestate.Answer(False, 'This guess was incorrect.'),
+			gamestate.Answer(True, 'This guess was correct.'),
+			gamestate.Answer(True, 'This one too.')
+		]),
 		42,
-		['Hint 1', 'Hint 2'],
-		[(False, message.author, 'Beach'), (True, message.author, 'Bathtub')],
-		[],
-		-1
+		gamestate.Hints([gamestate.Hint('Hint 1'), gamestate.Hint('Hint 2')]),
+		gamestate.Guesses([gamestate.Guess(False, author, 'Beach'), gamestate.Guess(True, author, 'Bathtub')]),
+		gamestate.GuessQueue(),
+		-1,
+		game.display_name
 	))
 
 
+HISTORY_PAGE = 10
+# A year and month, optionally with a day, to list the games from (see Archive.games_on).
+_DATE = re.compile(r'\d{4}-\d{2}(-\d{2})?')
+
+
+def _history_line(entry):
+	defender = f'<@{entry["defender"]}>' if entry['defender'] else 'nobody'
+	winner = f'won by <@{entry["winner"]}>' if entry['winner'] else 'no winner'
+	kind = ' (backup)' if entry['kind'] == 'backup' else ''
+	return (
+		f'**#{entry["n"]}**{kind} {entry["date"].replace("T", " ")}: {defender}, {entry["answers"]} answers, '
+		f'{entry["guesses"]} guesses, {winner}'
+	)
+
+
+async def history(game, message, args):
+	if args and args[0].lstrip('#').isdigit():
+		n = int(args[0].lstrip('#'))
+		try:
+			entry = game.archive.entry(n)
+			status = gamestate.GameState.from_dict(game.archive.read(n))
+		except IndexError:
+			await game.send(f'There\'s no game #{n} in the history of this channel.')
+			return
+		# Users who left since are looked up once, so that they're shown by name if possible.
+		await game.client.user_cache.resolve(game.client, status.user_ids())
+		await game.send(f'Game #{n} from {entry["date"].replace("T", " ")}:')
+		for fragment in status_format.collapse_breakpoints(status_format.split_breakpoints(status_format.apply(
+			game.user(status.defender) if status.defender is not None else None,
+			status.answers,
+			entry.get('max_questions', game.max_questions),
+			status.hints,
+			status.guesses,
+			status.guess_queue,
+			entry.get('max_guesses', game.max_guesses),
+			game.display_name
+		)), b20q.MAX_MESSAGE_LENGTH):
+			await game.send(fragment)
+		return
+	if message.mentions:
+		numbers = game.archive.games_of(message.mentions[0].id)[-HISTORY_PAGE:]
+		entries = [game.archive.entry(n) for n in numbers]
+	elif args and _DATE.fullmatch(args[0]):
+		numbers = game.archive.games_on(args[0])[-HISTORY_PAGE:]
+		entries = [game.archive.entry(n) for n in numbers]
+	else:
+		entries = game.archive.index[-HISTORY_PAGE:]
+	if not entries:
+		await game.send('No games found.')
+		return
+	await game.send(
+		'\n'.join(_history_line(e) for e in reversed(entries)) +
+		f'\nUse _{game.prefix}history <number>_ to see one of them.',
+		allowed_mentions=discord.AllowedMentions.none()
+	)
+
+
+LEADERBOARD_SIZE = 10
+
+
+def _format_duration(seconds):
+	minutes, seconds = divmod(round(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return f'{hours}h {minutes}m' if hours else f'{minutes}m {seconds}s'
+
+
+async def leaderboard(game, message, args):
+	board = game.client.stats.leaderboard(game.key[0], LEADERBOARD_SIZE)
+	if not board:
+		await game.send('Nobody has won a game here yet.')
+		return
+	lines = ['**Leaderboard**']
+	for rank, user in enumerate(board, 1):
+		player = game.client.stats.get(game.key[0], user)
+		lines.append(f'{rank}. <@{user}>: {player["wins"]} wins, {player["accuracy"]:.0%} of {player["guesses"]} guesses correct')
+	await game.send('\n'.join(lines), allowed_mentions=discord.AllowedMentions.none())
+
+
+async def stats(game, message, args):
+	user = message.mentions[0] if message.mentions else message.author
+	player = game.client.stats.get(game.key[0], user.id)
+	if player is None:
+		await game.send(f'{user} hasn\'t played here yet.')
+		return
+	lines = [
+		f'**Stats of {user}**',
+		f'Wins: {player["wins"]}',
+		f'Guesses: {player["guesses"]}' + (f' ({player["accuracy"]:.0%} correct)' if player['guesses'] else ''),
+		f'Games defended: {player["defended"]} ({player["stumped"]} without a winner)'
+	]
+	if player['average_questions'] is not None:
+		lines.append(f'Average questions to a win: {player["average_questions"]:.1f}')
+	if player['average_seconds'] is not None:
+		lines.append(f'Average time to a win: {_format_duration(player["average_seconds"])}')
+	await game.send('\n'.join(lines))
+
+
 @mod_only
-async def id_(message):
+async def id_(game, message, args):
 	if message.mentions:
 		await game.send(message.mentions[0].id)
-	elif message.content.startswith(f'{game.prefix}id guild'):
+	elif args and args[0] == 'guild':
 		await game.send(message.guild.id)
 	else:
 		await game.send(message.author.id)
 
 
 @mod_only
-async def save(message):
-	content = message.content.lstrip(game.prefix)
-	filename = content.split()[1] if len(content.split()) > 1 else 'status.json'
+async def metrics_(game, message, args):
+	await game.send(f'```\n{metrics.summary()}\n```')
+
+
+@mod_only
+async def save(game, message, args):
+	filename = args[0] if args else 'status.json'
 	if filename == 'stdout':
 		sys.stdout.write(game.status_as_json())
 	elif filename == 'here':
 		await game.send(game.status_as_json())
 	elif filename == 'backup':
-		game.save(overwrite=False)
+		n = await game.archive_game('backup')
+		await game.send(f'Saved as #{n} in the history.')
 	else:
-		game.save()
-	await message.add_reaction('✅')
+		await game.flush()
+	await game.react(message, '✅')
+
+
+@mod_only
+async def profile(game, message, args):
+	kind = args[0] if args else 'cpu'
+	seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+	if kind not in profiler.KINDS:
+		await game.send(f'Format: {game.prefix}profile [{"|".join(profiler.KINDS)}] [seconds]')
+		return
+	await game.react(message, '⏳')
+	try:
+		path, summary = await profiler.profile(kind, seconds)
+	except RuntimeError:
+		await game.send(f'{message.author.mention} A profile is already running. Try again when it\'s done.')
+		return
+	summary = summary[:b20q.MAX_MESSAGE_LENGTH - 100 - len(path)]
+	await game.send(f'```\n{summary}\n```Full results: `{path}`')
 
 
 @mod_only
 @save_before_execute
-async def shutdown(message):
-	await message.add_reaction('✅')
+async def shutdown(game, message, args):
+	await game.react(message, '✅')
+	await game.client.games.drain_all()
 	await game.client.close()
 	sys.exit(0)
 
 
+# Modules that `update` can reload in place. Any other changed module holds live objects
+# (games, journals, outboxes...), so b20q is restarted instead.
+RELOADABLE = ('utils', 'status_format', 'commands')
+
+
+async def _run(*args):
+	# Runs a program without blocking the event loop and returns (exit code, stdout).
+	process = await asyncio.create_subprocess_exec(
+		*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+	)
+	output, _ = await process.communicate()
+	return process.returncode, output.decode(errors='replace').strip()
+
+
+async def _changed_files():
+	# Returns the files changed by ./update.sh, or None if that can't be told (in which case b20q should restart).
+	code, before = await _run('git', 'rev-parse', 'HEAD')
+	if code != 0:
+		return None
+	code, output = await _run('./update.sh')
+	if code != 0:
+		sys.stderr.write(f'./update.sh failed with exit code {code}:\n{output}\n')
+		return None
+	code, after = await _run('git', 'rev-parse', 'HEAD')
+	if code != 0:
+		return None
+	code, output = await _run('git', 'diff', '--name-only', before, after)
+	return output.split() if code == 0 else None
+
+
+def _reload(client):
+	for name in RELOADABLE:
+		importlib.reload(sys.modules[name])
+	for game in client.games:
+		# Renderers created before the reload would keep using the old code.
+		game.renderer = status_format.StatusRenderer(game.display_name)
+
+
 @mod_only
 @save_before_execute
-async def update(message):
-	await message.add_reaction('💤')
+async def update(game, message, args):
+	if 'B20Q_SHARD_IDS' in os.environ:
+		# The checkout is shared with the other shard processes, which would keep running the old code.
+		await game.send(
+			f'{message.author.mention} This process only runs some of the shards. '
+			f'Stop shards.py, run ./update.sh, then start shards.py again.'
+		)
+		return
+	await game.react(message, '💤')
+	changed = await _changed_files()
+	modules = None if changed is None else {os.path.splitext(f)[0] for f in changed if f.endswith('.py')}
+	if modules is not None and modules <= set(RELOADABLE):
+		# Only reload what changed, keeping games, pending confirmations and the connection.
+		if modules:
+			_reload(game.client)
+		sys.stderr.write(f'Updated in place; changed files: {", ".join(changed) or "none"}\n')
+		await game.react(message, '✅')
+		return
+	# Restart. Everything was just snapshotted, so the new process doesn't have to replay any journals.
 	updm = f'{message.channel.id}:{message.id}'
-	subprocess.run('./update.sh', capture_output=True)
+	await game.client.games.flush_all()
+	await game.client.games.drain_all()
 	if os.path.exists('./launch.sh'):
 		os.execle('/bin/sh', '/bin/sh', './launch.sh', {**os.environ, 'B20Q_UPDATE_MESSAGE': updm})
 	else:
 		os.execle('./venv/bin/python', './venv/bin/python', './b20q.py', {**os.environ, 'B20Q_UPDATE_MESSAGE': updm})
+
+COMMANDS = {
+	'start': start,
+	'show': show, 'sh': show,
+	'status': status, 's': status,
+	'help': help_,
+	'history': history,
+	'leaderboard': leaderboard, 'lb': leaderboard,
+	'stats': stats,
+	'open': open_,
+	'confirm': confirm,
+	'deny': deny,
+
+	'edit': edit, 'e': edit,
+	'delete': delete, 'd': delete,
+	'hint': hint, 'h': hint,
+	# "yes <answer>" and "no <answer>" are shorthands for "answer yes <answer>" and "answer no <answer>".
+	'answer': answer, 'yes': (answer, ('yes',)), 'no': (answer, ('no',)),
+	'incorrect': incorrect, 'i': incorrect,
+	'correct': correct, 'c': correct,
+	'end': end,
+
+	'guess': guess, 'g': guess,
+	'unguess': unguess, 'ung': unguess,
+
+	'mod': mod,
+	'unmod': unmod,
+	'ismod': is_mod, 'is mod': is_mod, 'am i mod': is_mod,
+	'sample': sample,
+	'id': id_,
+	'metrics': metrics_,
+	'save': save,
+	'profile': profile,
+	'shutdown': shutdown, 'off': shutdown,
+	'update': update
+}
+_COMMAND_TRIE = _build_command_trie(COMMANDS)
@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: Apache-2.0
+import asyncio
+import heapq
+import itertools
+import sys
+import time
+from collections import deque
+
+# Number of requests one user can have waiting for their answer, and for a whole game.
+MAX_PENDING_PER_USER = 5
+MAX_PENDING = 50
+
+
+class _Request:
+	__slots__ = ('user_id', 'requester_id', 'success', 'fail', 'deadline', 'done')
+
+	def __init__(self, user_id, requester_id, success, fail, deadline):
+		self.user_id = user_id
+		self.requester_id = requester_id
+		self.success = success
+		self.fail = fail
+		self.deadline = deadline
+		self.done = False
+
+
+class ConfirmationQueue:
+	"""
+	Requests waiting for a user to confirm or deny them, e.g. the previous winner allowing someone else to start.
+	`success` and `fail` are callables returning awaitables (or None), so nothing is created until one of them runs.
+	Every request expires after `timeout` seconds, which runs its fail path. A single task sleeps until the earliest
+	deadline in a heap; answered requests are skipped when they come up, or dropped earlier if they pile up.
+	"""
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self._pending = {}  # user ID: deque of requests, oldest first
+		self._heap = []  # (deadline, counter, request)
+		self._counter = itertools.count()
+		self._expirer = None
+		self._wakeup = asyncio.Event()
+
+	def __len__(self):
+		return sum(map(len, self._pending.values()))
+
+	def __contains__(self, user_id):
+		return user_id in self._pending
+
+	def requesters(self, user_id):
+		# IDs of the users waiting for this user's answer, oldest request first.
+		return [request.requester_id for request in self._pending.get(user_id, ())]
+
+	def add(self, user_id, requester_id, success, fail=None):
+		# Raises ValueError if the requester is already waiting for this user or too many requests are pending.
+		requests = self._pending.get(user_id, ())
+		if any(request.requester_id == requester_id for request in requests):
+			raise ValueError(f'{requester_id} is already waiting for {user_id}')
+		if len(requests) >= MAX_PENDING_PER_USER or len(self) >= MAX_PENDING:
+			raise ValueError('Too many pending requests')
+		request = _Request(user_id, requester_id, success, fail, time.monotonic() + self.timeout)
+		self._pending.setdefault(user_id, deque()).append(request)
+		earliest = self._heap[0][0] if self._heap else None
+		heapq.heappush(self._heap, (request.deadline, next(self._counter), request))
+		if self._expirer is None or self._expirer.done():
+			self._expirer = asyncio.ensure_future(self._expire())
+		elif earliest is None or request.deadline < earliest:
+			# The task is sleeping until a later deadline, e.g. because the timeout was lowered.
+			self._wakeup.set()
+
+	async def confirm(self, user_id, requester_id=None):
+		# Runs the success path of the user's oldest request (or the one by requester_id). Returns False if none.
+		request = self._take(user_id, requester_id)
+		if request is None:
+			return False
+		if request.success is not None:
+			await request.success()
+		return True
+
+	async def deny(self, user_id, requester_id=None):
+		request = self._take(user_id, requester_id)
+		if request is None:
+			return False
+		if request.fail is not None:
+			await request.fail()
+		return True
+
+	def _take(self, user_id, requester_id):
+		requests = self._pending.get(user_id)
+		if not requests:
+			return None
+		for request in requests:
+			if requester_id is None or request.requester_id == requester_id:
+				break
+		else:
+			return None
+		self._remove(request)
+		done = len(self._heap) - len(self)
+		if done > len(self._heap) // 2:
+			# Mostly answered requests; don't keep them around until their deadlines.
+			self._heap = [entry for entry in self._heap if not entry[2].done]
+			heapq.heapify(self._heap)
+		return request
+
+	def _remove(self, request):
+		request.done = True
+		requests = self._pending[request.user_id]
+		requests.remove(request)
+		if not requests:
+			del self._pending[request.user_id]
+
+	async def _expire(self):
+		while self._heap:
+			deadline, _, request = self._heap[0]
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				self._wakeup.clear()
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), delay)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			heapq.heappop(self._heap)
+			if request.done:
+				continue
+			self._remove(request)
+			if request.fail is not None:
+				try:
+					await request.fail()
+				except Exception as e:
+					sys.stderr.write(f'Error while expiring a confirmation request: {e!r}\n')
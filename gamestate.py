@@ -0,0 +1,200 @@
+# SPDX-License-Identifier: Apache-2.0
+from array import array
+from collections import OrderedDict
+
+# The status of a game. Users are stored as their IDs and only looked up when something is shown (see b20qGame.user),
+# and answers and guesses are stored as columns, with the yes/no and correct flags in byte arrays.
+# Indexing or iterating over them creates the records below on demand.
+# to_dict() and from_dict() convert to and from the JSON structure used by status files and archives.
+
+
+class Answer:
+	__slots__ = ('correct', 'text')
+
+	def __init__(self, correct, text):
+		self.correct = correct
+		self.text = text
+
+
+class Hint:
+	__slots__ = ('text',)
+
+	def __init__(self, text):
+		self.text = text
+
+
+class Guess:
+	__slots__ = ('correct', 'user_id', 'text')
+
+	def __init__(self, correct, user_id, text):
+		self.correct = correct
+		self.user_id = user_id
+		self.text = text
+
+
+class QueuedGuess:
+	__slots__ = ('user_id', 'text')
+
+	def __init__(self, user_id, text):
+		self.user_id = user_id
+		self.text = text
+
+
+class Answers:
+	__slots__ = ('texts', 'flags')
+
+	def __init__(self, answers=()):
+		self.texts = []
+		self.flags = array('b')
+		for answer in answers:
+			self.append(answer)
+
+	def __len__(self):
+		return len(self.texts)
+
+	def __getitem__(self, index):
+		return Answer(bool(self.flags[index]), self.texts[index])
+
+	def __setitem__(self, index, answer):
+		self.texts[index] = answer.text
+		self.flags[index] = answer.correct
+
+	def __delitem__(self, index):
+		del self.texts[index]
+		del self.flags[index]
+
+	def __iter__(self):
+		return map(Answer, map(bool, self.flags), self.texts)
+
+	def append(self, answer):
+		self.texts.append(answer.text)
+		self.flags.append(answer.correct)
+
+
+class Hints:
+	__slots__ = ('texts',)
+
+	def __init__(self, hints=()):
+		self.texts = [hint.text for hint in hints]
+
+	def __len__(self):
+		return len(self.texts)
+
+	def __getitem__(self, index):
+		return Hint(self.texts[index])
+
+	def __setitem__(self, index, hint):
+		self.texts[index] = hint.text
+
+	def __delitem__(self, index):
+		del self.texts[index]
+
+	def __iter__(self):
+		return map(Hint, self.texts)
+
+	def append(self, hint):
+		self.texts.append(hint.text)
+
+
+class Guesses:
+	__slots__ = ('texts', 'user_ids', 'flags')
+
+	def __init__(self, guesses=()):
+		self.texts = []
+		self.user_ids = array('q')
+		self.flags = array('b')
+		for guess in guesses:
+			self.append(guess)
+
+	def __len__(self):
+		return len(self.texts)
+
+	def __getitem__(self, index):
+		return Guess(bool(self.flags[index]), self.user_ids[index], self.texts[index])
+
+	def __iter__(self):
+		return map(Guess, map(bool, self.flags), self.user_ids, self.texts)
+
+	def append(self, guess):
+		self.texts.append(guess.text)
+		self.user_ids.append(guess.user_id)
+		self.flags.append(guess.correct)
+
+
+class GuessQueue:
+	# Pending guesses by user ID, in the order they were made. Each user can have one pending guess.
+	__slots__ = ('guesses',)
+
+	def __init__(self, guesses=()):
+		self.guesses = OrderedDict((guess.user_id, guess.text) for guess in guesses)
+
+	def __len__(self):
+		return len(self.guesses)
+
+	def __contains__(self, user_id):
+		return user_id in self.guesses
+
+	def __getitem__(self, user_id):
+		# Returns the user's pending guess. Raises KeyError if they have none.
+		return self.guesses[user_id]
+
+	def __iter__(self):
+		return map(QueuedGuess, self.guesses.keys(), self.guesses.values())
+
+	def first(self):
+		# The oldest pending guess, or None.
+		for user_id, text in self.guesses.items():
+			return QueuedGuess(user_id, text)
+		return None
+
+	def put(self, user_id, text):
+		self.guesses[user_id] = text
+
+	def remove(self, user_id):
+		del self.guesses[user_id]
+
+	def clear(self):
+		self.guesses.clear()
+
+
+class GameState:
+	__slots__ = ('defender', 'winner', 'started', 'answers', 'hints', 'guesses', 'guess_queue')
+
+	def __init__(self):
+		self.defender = None  # user ID
+		self.winner = None  # user ID
+		self.started = None  # time.time() when the game was started
+		self.answers = Answers()
+		self.hints = Hints()
+		self.guesses = Guesses()
+		self.guess_queue = GuessQueue()
+
+	def user_ids(self):
+		# Every user that appears in the status.
+		ids = {self.defender, self.winner, *self.guesses.user_ids, *self.guess_queue.guesses}
+		ids.discard(None)
+		return ids
+
+	def to_dict(self):
+		return {
+			'winner': self.winner,
+			'defender': self.defender,
+			'started': self.started,
+			'answers': [[bool(c), a] for c, a in zip(self.answers.flags, self.answers.texts)],
+			'hints': list(self.hints.texts),
+			'guesses': [[bool(c), u, g] for c, u, g in zip(self.guesses.flags, self.guesses.user_ids, self.guesses.texts)],
+			'guess_queue': dict(self.guess_queue.guesses)
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		# Missing keys keep their defaults, since older status files don't have all of them.
+		state = cls()
+		state.winner = data.get('winner')
+		state.defender = data.get('defender')
+		state.started = data.get('started')
+		state.answers = Answers(Answer(c, a) for c, a in data.get('answers', ()))
+		state.hints = Hints(Hint(h) for h in data.get('hints', ()))
+		state.guesses = Guesses(Guess(c, u, g) for c, u, g in data.get('guesses', ()))
+		state.guess_queue = GuessQueue(QueuedGuess(int(u), g) for u, g in data.get('guess_queue', {}).items())
+		return state
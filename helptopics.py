@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: Apache-2.0
+import os
+import time
+
+# How often (in seconds) to check whether the topics were edited.
+RECHECK_INTERVAL = 5.0
+
+
+def split_lines(text, max_length):
+	# Splits text into parts of at most max_length characters, preferring to break between lines.
+	parts, current = [], ''
+	for line in text.splitlines(keepends=True):
+		while len(line) > max_length:
+			if current:
+				parts.append(current)
+				current = ''
+			parts.append(line[:max_length])
+			line = line[max_length:]
+		if len(current) + len(line) > max_length:
+			parts.append(current)
+			current = ''
+		current += line
+	if current or not parts:
+		parts.append(current)
+	return [part.rstrip('\n') for part in parts]
+
+
+class HelpTopics:
+	"""
+	Every <directory>/<topic>.txt, rendered with the prefix and split into messages of at most max_length.
+	Topics are read once and kept until a file in the directory changes (checked at most every RECHECK_INTERVAL)
+	or a different prefix is asked for, so answering help requests doesn't touch the filesystem.
+	"""
+	def __init__(self, directory, max_length):
+		self.directory = directory
+		self.max_length = max_length
+		self.topics = None
+		self._prefix = None
+		self._mtime = None
+		self._checked = 0.0
+
+	def _stat(self):
+		try:
+			with os.scandir(self.directory) as entries:
+				return max([os.stat(self.directory).st_mtime_ns] + [e.stat().st_mtime_ns for e in entries])
+		except FileNotFoundError:
+			return None
+
+	def _load(self, prefix):
+		self.topics = {}
+		self._prefix = prefix
+		self._mtime = self._stat()
+		self._checked = time.monotonic()
+		if self._mtime is None:
+			return
+		for filename in os.listdir(self.directory):
+			topic, extension = os.path.splitext(filename)
+			if extension == '.txt':
+				with open(os.path.join(self.directory, filename)) as f:
+					self.topics[topic] = split_lines(f.read().replace('%prefix%', prefix), self.max_length)
+
+	def get(self, topic, prefix):
+		# Returns the topic's messages, or None if there's no such topic.
+		now = time.monotonic()
+		if self.topics is None or prefix != self._prefix:
+			self._load(prefix)
+		elif now - self._checked >= RECHECK_INTERVAL:
+			self._checked = now
+			if self._stat() != self._mtime:
+				self._load(prefix)
+		return self.topics.get(topic)
@@ -0,0 +1,242 @@
+# SPDX-License-Identifier: Apache-2.0
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import gamestate
+import metrics
+import utils
+
+# Every mutation of a game's status is appended to <status file>.journal as one JSON line: [seq, op, *args].
+# Once enough entries have piled up, the full status is written to the status file (the snapshot) together with
+# the sequence number of the last entry it includes, and the journal is started over.
+# On startup, the snapshot is loaded and every journal entry with a higher sequence number is replayed on top of it.
+# All files are written from worker threads (see Journal), and snapshots replace the status file atomically.
+
+
+def apply(status, op, *args):
+	# Applies one journal entry to a GameState. Users are given as user IDs.
+	if op == 'set':
+		key, value = args
+		setattr(status, key, value)
+	elif op == 'start':
+		status.winner = None
+		status.defender = args[0]
+		status.answers = gamestate.Answers()
+		status.hints = gamestate.Hints()
+		status.guesses = gamestate.Guesses()
+		status.guess_queue = gamestate.GuessQueue()
+	elif op == 'answer':
+		correct, answer = args
+		status.answers.append(gamestate.Answer(correct, answer))
+	elif op == 'hint':
+		status.hints.append(gamestate.Hint(args[0]))
+	elif op == 'edit':
+		part, index, value = args
+		if part == 'answers':
+			status.answers[index] = gamestate.Answer(*value)
+		else:
+			status.hints[index] = gamestate.Hint(value)
+	elif op == 'delete':
+		part, index = args
+		del getattr(status, part)[index]
+	elif op == 'guess':
+		correct, user, guess = args
+		status.guesses.append(gamestate.Guess(correct, user, guess))
+	elif op == 'resolve':
+		# Several queued guesses confirmed as correct or incorrect at once, in the given order.
+		correct, users = args
+		texts = [status.guess_queue[user] for user in users]
+		for user, text in zip(users, texts):
+			status.guesses.append(gamestate.Guess(correct, user, text))
+			status.guess_queue.remove(user)
+	elif op == 'queue':
+		user, guess = args
+		status.guess_queue.put(user, guess)
+	elif op == 'unqueue':
+		status.guess_queue.remove(args[0])
+	elif op == 'clear_queue':
+		status.guess_queue.clear()
+	else:
+		raise ValueError(f'Unknown journal operation: {op}')
+
+
+class Journal:
+	"""
+	Write-behind persistence for one game.
+	append() only buffers the entry in memory. commit() marks the journal dirty; a background task then waits
+	save_interval seconds, so that a burst of commands is written at once, and writes the buffered entries
+	(and, every snapshot_interval entries, a new snapshot) from a worker thread.
+	`snapshot` is a callable returning the serialized status including `journal_seq`.
+	`attached`, if given, is called whenever entries are taken for writing. It returns a callable (or None) that the
+	worker thread runs right after writing them, for files that have to stay in step with the journal.
+	Flushes run one at a time, so entries are always written in the order they were taken.
+	"""
+	def __init__(self, path, snapshot, save_interval=2.0, snapshot_interval=256, attached=None):
+		self.path = path
+		self.log_path = os.path.splitext(path)[0] + '.journal'
+		# While a snapshot is being written, the entries it covers are kept here.
+		self.old_log_path = self.log_path + '.old'
+		self.snapshot = snapshot
+		self.attached = attached
+		self.save_interval = save_interval
+		self.snapshot_interval = snapshot_interval
+		self.seq = 0
+		self.pending = 0
+		self._buffer = []
+		self._file = None
+		self._lock = threading.Lock()
+		self._flush_lock = asyncio.Lock()
+		self._written_seq = -1
+		self._writer = None
+
+	@property
+	def dirty(self):
+		return bool(self._buffer)
+
+	def append(self, op, *args):
+		self.seq += 1
+		self.pending += 1
+		self._buffer.append(json.dumps([self.seq, op, *args]) + '\n')
+
+	def commit(self):
+		if self._writer is None or self._writer.done():
+			self._writer = asyncio.ensure_future(self._write_behind())
+
+	async def _write_behind(self):
+		while self.dirty:
+			await asyncio.sleep(self.save_interval)
+			await self.flush()
+
+	def _take(self, force_snapshot):
+		# Collects everything that should be written next. Must be called from the event loop.
+		lines, self._buffer = self._buffer, []
+		snapshot = None
+		if force_snapshot or self.pending >= self.snapshot_interval:
+			snapshot = self.snapshot(self.seq)
+			self.pending = 0
+		return lines, snapshot, self.seq, self.attached() if self.attached is not None else None
+
+	async def flush(self, snapshot=False):
+		# Entries are only taken once the previous flush has been written; see _write_snapshot() for why.
+		async with self._flush_lock:
+			await asyncio.get_event_loop().run_in_executor(None, self._write, *self._take(snapshot))
+
+	def save(self):
+		# Synchronously writes a snapshot, e.g. when the event loop isn't running anymore.
+		self._write(*self._take(True))
+
+	def close(self):
+		with self._lock:
+			self._close()
+
+	def _close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def load(self):
+		# Returns the snapshot as a GameState with all newer journal entries applied.
+		# Raises FileNotFoundError if there's neither a snapshot nor a journal.
+		found = False
+		data = {}
+		if os.path.exists(self.path):
+			found = True
+			with open(self.path) as s:
+				data = json.load(s)
+		self.seq = data.pop('journal_seq', 0)
+		self._written_seq = self.seq
+		status = gamestate.GameState.from_dict(data)
+		# Keyed by seq: a crash while rotating can leave the same entries in both files.
+		entries = {}
+		for path in (self.old_log_path, self.log_path):
+			if not os.path.exists(path):
+				continue
+			found = True
+			with open(path) as log:
+				for n, line in enumerate(log):
+					try:
+						seq, op, *args = json.loads(line)
+					except ValueError:
+						# Most likely a write that was cut short by a crash; everything before it is still good.
+						sys.stderr.write(f'Skipping unreadable entry on line {n + 1} of {path}.\n')
+						continue
+					if seq > self.seq:
+						entries[seq] = (op, args)
+		if not found:
+			raise FileNotFoundError(self.path)
+		for seq in sorted(entries):
+			op, args = entries[seq]
+			apply(status, op, *args)
+			self.seq = seq
+		self.pending = len(entries)
+		return status
+
+	def _write(self, lines, snapshot, seq, attached=None):
+		# Runs in a worker thread, except when called from save().
+		with self._lock:
+			start = time.perf_counter()
+			if lines:
+				self._append_lines(lines)
+			if snapshot is not None and seq >= self._written_seq:
+				# Otherwise a newer snapshot has already been written, and the journal belongs to it.
+				self._rotate()
+				self._write_snapshot(snapshot, seq)
+			if attached is not None:
+				attached()
+			metrics.save_duration.observe(time.perf_counter() - start)
+			metrics.save_size.observe(sum(map(len, lines)) + len(snapshot or ''))
+
+	def _append_lines(self, lines):
+		if self._file is None:
+			os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+			self._file = open(self.log_path, 'a')
+			if self._file.tell() and not self._ends_with_newline():
+				# Don't glue the first new entry onto an entry that was cut short by a crash.
+				self._file.write('\n')
+		self._file.write(''.join(lines))
+		self._file.flush()
+
+	def _ends_with_newline(self):
+		with open(self.log_path, 'rb') as log:
+			log.seek(-1, os.SEEK_END)
+			return log.read(1) == b'\n'
+
+	def _rotate(self):
+		# Moves the current journal aside until the snapshot that covers it has been written.
+		self._close()
+		if not os.path.exists(self.log_path):
+			return
+		if os.path.exists(self.old_log_path):
+			# The previous snapshot was never written; keep its entries too.
+			with open(self.log_path) as log, open(self.old_log_path, 'a') as old:
+				old.write(log.read())
+			os.remove(self.log_path)
+		else:
+			os.replace(self.log_path, self.old_log_path)
+
+	def _write_snapshot(self, snapshot, seq):
+		os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+		utils.write_atomic(self.path, snapshot, sync=True)
+		self._written_seq = seq
+		self._prune_old_log(seq)
+
+	def _prune_old_log(self, seq):
+		# Drops the moved-aside entries that the snapshot up to `seq` covers. Newer ones (which could only get there
+		# if writes were reordered) are kept, since the snapshot doesn't include them.
+		if not os.path.exists(self.old_log_path):
+			return
+		newer = []
+		with open(self.old_log_path) as old:
+			for line in old:
+				try:
+					if json.loads(line)[0] > seq:
+						newer.append(line)
+				except (ValueError, IndexError, TypeError):
+					continue
+		if newer:
+			utils.write_atomic(self.old_log_path, ''.join(newer))
+		else:
+			os.remove(self.old_log_path)
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: Apache-2.0
+# In-process metrics, exposed in the Prometheus text format by serve() and summarized by the `metrics` command.
+import bisect
+import sys
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the latency buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds (in bytes) of the size buckets.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def quantile(self, q):
+		# Upper bound of the bucket that contains the q-th quantile; good enough to compare commands.
+		if not self.count:
+			return 0.0
+		rank = q * self.count
+		seen = 0
+		for bound, count in zip(self.buckets, self.counts):
+			seen += count
+			if seen >= rank:
+				return bound
+		return float('inf')
+
+
+command_latency = defaultdict(Histogram)
+command_errors = defaultdict(int)
+save_duration = Histogram()
+save_size = Histogram(SIZE_BUCKETS)
+send_latency = Histogram()
+event_lag = Histogram()
+load_duration = Histogram()
+# Seconds spent in each phase of starting up: {phase: seconds}, in the order the phases finished.
+startup = {}
+# name: (help, callable returning the current value)
+gauges = {}
+
+HISTOGRAMS = (
+	('b20q_save_duration_seconds', 'Time spent writing journal entries and snapshots.', save_duration),
+	('b20q_save_size_bytes', 'Bytes written per journal write or snapshot.', save_size),
+	('b20q_send_latency_seconds', 'Time between queueing an outgoing message or reaction and delivering it.', send_latency),
+	('b20q_event_lag_seconds', 'Time between a message being created and b20q handling it.', event_lag),
+	('b20q_load_duration_seconds', 'Time spent loading a game\'s status from disk.', load_duration)
+)
+
+
+def gauge(name, help, fn):
+	gauges[name] = (help, fn)
+
+
+def _histogram_lines(name, histogram, labels=''):
+	separator = ',' if labels else ''
+	cumulative = 0
+	for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+		cumulative += count
+		yield f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+	braces = f'{{{labels}}}' if labels else ''
+	yield f'{name}_sum{braces} {histogram.sum}'
+	yield f'{name}_count{braces} {histogram.count}'
+
+
+def render():
+	lines = [
+		'# HELP b20q_command_duration_seconds Time spent handling a command.',
+		'# TYPE b20q_command_duration_seconds histogram'
+	]
+	for command, histogram in sorted(command_latency.items()):
+		lines.extend(_histogram_lines('b20q_command_duration_seconds', histogram, f'command="{command}"'))
+	lines += [
+		'# HELP b20q_command_errors_total Commands that raised an exception.',
+		'# TYPE b20q_command_errors_total counter'
+	]
+	lines.extend(f'b20q_command_errors_total{{command="{c}"}} {n}' for c, n in sorted(command_errors.items()))
+	for name, help, histogram in HISTOGRAMS:
+		lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+		lines.extend(_histogram_lines(name, histogram))
+	lines += [
+		'# HELP b20q_startup_seconds Time spent in each phase of starting up.',
+		'# TYPE b20q_startup_seconds gauge'
+	]
+	lines.extend(f'b20q_startup_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in startup.items())
+	for name, (help, fn) in sorted(gauges.items()):
+		lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {fn()}']
+	return '\n'.join(lines) + '\n'
+
+
+def summary(top=10):
+	# Commands sorted by the total wall time spent handling them. That includes awaits (replies, sleeps, subprocesses),
+	# so it shows which commands are slow to answer, not which ones block the event loop; use `profile loop` for that.
+	ranked = sorted(command_latency.items(), key=lambda item: item[1].sum, reverse=True)[:top]
+	lines = [f'{"command":<12}{"count":>8}{"total":>10}{"p50":>9}{"p99":>9}{"errors":>8}']
+	for command, h in ranked:
+		lines.append(
+			f'{command:<12}{h.count:>8}{h.sum:>9.2f}s{h.quantile(0.5) * 1000:>7g}ms'
+			f'{h.quantile(0.99) * 1000:>7g}ms{command_errors.get(command, 0):>8}'
+		)
+	for name, _, histogram in HISTOGRAMS:
+		lines.append(f'{name[5:]}: n={histogram.count}, p50≤{histogram.quantile(0.5)}, p99≤{histogram.quantile(0.99)}')
+	lines.extend(f'{name[5:]}: {fn()}' for name, (help, fn) in sorted(gauges.items()))
+	if startup:
+		lines.append('startup: ' + ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in startup.items()))
+	return '\n'.join(lines)
+
+
+async def serve(host, port):
+	# Serves render() at http://host:port/metrics. Returns the aiohttp runner, or None if aiohttp is missing.
+	try:
+		from aiohttp import web
+	except ImportError:
+		sys.stderr.write('aiohttp is not installed; the metrics endpoint is disabled.\n')
+		return None
+
+	async def handle(request):
+		return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+	app = web.Application()
+	app.router.add_get('/metrics', handle)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	await web.TCPSite(runner, host, port).start()
+	return runner
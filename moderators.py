@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: Apache-2.0
+import json
+import os
+import sys
+import time
+
+import utils
+
+# How often (in seconds) to check whether the file was edited by something other than b20q.
+RECHECK_INTERVAL = 5.0
+
+
+class ModeratorIndex:
+	# In-memory copy of mods.json: {guild ID: set of user IDs}.
+	# The file is only read on startup and when its mtime changes, and only written when the list changes.
+	def __init__(self, path='mods.json'):
+		self.path = path
+		self.mods = {}
+		self._mtime = None
+		self._checked = 0.0
+		self.reload()
+
+	def _stat(self):
+		try:
+			return os.stat(self.path).st_mtime_ns
+		except FileNotFoundError:
+			return None
+
+	def reload(self):
+		self._mtime = self._stat()
+		self._checked = time.monotonic()
+		self.mods = {}
+		if self._mtime is None:
+			return
+		try:
+			with open(self.path) as mods:
+				# Older versions could write the same guild twice (once under an int key), so merge duplicates.
+				json.load(mods, object_pairs_hook=self._merge_pairs)
+		except (json.JSONDecodeError, ValueError) as e:
+			sys.stderr.write(f'Error while loading moderators from {self.path}: {e!r}\n')
+
+	def _merge_pairs(self, pairs):
+		if pairs and all(isinstance(v, list) for k, v in pairs):
+			for guild, users in pairs:
+				self.mods.setdefault(int(guild), set()).update(users)
+		return dict(pairs)
+
+	def _refresh(self):
+		now = time.monotonic()
+		if now - self._checked < RECHECK_INTERVAL:
+			return
+		self._checked = now
+		if self._stat() != self._mtime:
+			self.reload()
+
+	def _write(self):
+		mods = {str(guild): sorted(users) for guild, users in self.mods.items() if users}
+		utils.write_atomic(self.path, json.dumps(mods))
+		self._mtime = self._stat()
+
+	def is_moderator(self, user, guild):
+		self._refresh()
+		return user.id in self.mods.get(guild.id, ())
+
+	def add(self, user, guild):
+		self._refresh()
+		self.mods.setdefault(guild.id, set()).add(user.id)
+		self._write()
+
+	def remove(self, user, guild):
+		self._refresh()
+		if user.id in self.mods.get(guild.id, ()):
+			self.mods[guild.id].discard(user.id)
+			self._write()
+
+
+class PartitionedModerators:
+	# Same interface as ModeratorIndex, but with one file per guild (<directory>/<guild ID>.json),
+	# so that processes serving different guilds never write to the same file.
+	# A guild's file is created from the single-file list (`legacy`) the first time the guild is used.
+	def __init__(self, directory='mods', legacy='mods.json'):
+		self.directory = directory
+		self.legacy = legacy
+		self.guilds = {}
+		self._legacy_mods = None
+		os.makedirs(directory, exist_ok=True)
+
+	def _index(self, guild):
+		index = self.guilds.get(guild.id)
+		if index is None:
+			path = os.path.join(self.directory, f'{guild.id}.json')
+			seed = not os.path.exists(path)
+			index = self.guilds[guild.id] = ModeratorIndex(path)
+			if seed:
+				if self._legacy_mods is None:
+					self._legacy_mods = ModeratorIndex(self.legacy).mods
+				if self._legacy_mods.get(guild.id):
+					index.mods[guild.id] = set(self._legacy_mods[guild.id])
+					index._write()
+		return index
+
+	def is_moderator(self, user, guild):
+		return self._index(guild).is_moderator(user, guild)
+
+	def add(self, user, guild):
+		self._index(guild).add(user, guild)
+
+	def remove(self, user, guild):
+		self._index(guild).remove(user, guild)
@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: Apache-2.0
+from collections import OrderedDict
+
+# Maximum number of names kept per guild.
+MAX_NAMES_PER_GUILD = 2048
+
+
+class NameCache:
+	# Display names as shown in game statuses (i.e. with formatting removed): {guild ID: {user ID: name}}.
+	# Each guild's names are evicted least recently used first. Client20q drops names when members or users change.
+	def __init__(self, size=MAX_NAMES_PER_GUILD):
+		self.size = size
+		self.guilds = {}
+
+	def get(self, guild_id, user_id, look_up):
+		# Returns the cached name, or calls look_up() and caches its result.
+		names = self.guilds.setdefault(guild_id, OrderedDict())
+		try:
+			names.move_to_end(user_id)
+			return names[user_id]
+		except KeyError:
+			pass
+		name = names[user_id] = look_up()
+		if len(names) > self.size:
+			names.popitem(last=False)
+		return name
+
+	def invalidate(self, user_id, guild_id=None):
+		# Without a guild, the user's name is dropped everywhere. Returns the IDs of the guilds that had it cached.
+		guild_ids = list(self.guilds) if guild_id is None else [guild_id] if guild_id in self.guilds else []
+		return [i for i in guild_ids if self.guilds[i].pop(user_id, None) is not None]
@@ -0,0 +1,142 @@
+# SPDX-License-Identifier: Apache-2.0
+import asyncio
+import sys
+import time
+from collections import deque
+
+import metrics
+
+# Discord allows 5 messages per 5 seconds in a channel and roughly one reaction per 0.25 seconds.
+MESSAGE_RATE = (5, 5.0)
+REACTION_RATE = (1, 0.25)
+
+
+class _Bucket:
+	# Token bucket: up to `rate` operations per `per` seconds.
+	def __init__(self, rate, per):
+		self.rate = rate
+		self.per = per
+		self.tokens = rate
+		self.updated = time.monotonic()
+
+	async def acquire(self):
+		while True:
+			now = time.monotonic()
+			self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+			self.updated = now
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return
+			await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class _Message:
+	__slots__ = ('content', 'args', 'kwargs', 'queued')
+
+	def __init__(self, content, args, kwargs):
+		self.content = content
+		self.args = args
+		self.kwargs = kwargs
+		self.queued = time.monotonic()
+
+	@property
+	def plain(self):
+		# Only messages without attachments, embeds etc. can be merged.
+		return not (self.args or self.kwargs)
+
+
+class _Reaction:
+	__slots__ = ('message', 'emoji', 'queued')
+
+	def __init__(self, message, emoji):
+		self.message = message
+		self.emoji = emoji
+		self.queued = time.monotonic()
+
+
+class Outbox:
+	"""
+	Queue of everything b20q sends to one channel.
+	Sending only enqueues; a worker task delivers the queue in order, paced to stay within Discord's rate limits.
+	Adjacent plain messages are merged into one as long as the result fits in max_length,
+	and repeated reactions to the same message are only sent once.
+	"""
+	def __init__(self, channel, max_length):
+		self.channel = channel
+		self.max_length = max_length
+		self.sent = 0
+		# Seconds between queueing and delivering, for the last 100 deliveries.
+		self.latencies = deque(maxlen=100)
+		self._queue = deque()
+		self._worker = None
+		self._messages = _Bucket(*MESSAGE_RATE)
+		self._reactions = _Bucket(*REACTION_RATE)
+
+	@property
+	def depth(self):
+		return len(self._queue)
+
+	def send(self, content, *args, **kwargs):
+		self._enqueue(_Message(content, args, kwargs))
+
+	def react(self, message, emoji):
+		for item in self._queue:
+			if isinstance(item, _Reaction) and item.message.id == message.id and item.emoji == emoji:
+				return
+		self._enqueue(_Reaction(message, emoji))
+
+	async def drain(self):
+		# Waits until everything queued so far has been delivered.
+		while self._worker is not None and not self._worker.done():
+			await asyncio.shield(self._worker)
+
+	def _enqueue(self, item):
+		self._queue.append(item)
+		if self._worker is None or self._worker.done():
+			self._worker = asyncio.ensure_future(self._run())
+
+	def _next_message(self):
+		message = self._queue.popleft()
+		if not message.plain:
+			return message, [message]
+		parts, merged, length = [message.content], [message], len(message.content)
+		while self._queue and isinstance(self._queue[0], _Message) and self._queue[0].plain:
+			following = self._queue[0]
+			if length + 1 + len(following.content) > self.max_length:
+				break
+			self._queue.popleft()
+			parts.append(following.content)
+			merged.append(following)
+			length += 1 + len(following.content)
+		if len(merged) > 1:
+			message = _Message('\n'.join(parts), (), {})
+		return message, merged
+
+	async def _run(self):
+		while self._queue:
+			if isinstance(self._queue[0], _Reaction):
+				delivered = [self._queue.popleft()]
+				await self._reactions.acquire()
+				await self._deliver(delivered[0].message.add_reaction(delivered[0].emoji))
+			else:
+				message, delivered = self._next_message()
+				await self._messages.acquire()
+				await self._deliver(self.channel.send(message.content, *message.args, **message.kwargs))
+			now = time.monotonic()
+			for item in delivered:
+				self.latencies.append(now - item.queued)
+				metrics.send_latency.observe(now - item.queued)
+			self.sent += 1
+
+	async def _deliver(self, coroutine):
+		try:
+			await coroutine
+		except Exception as e:
+			sys.stderr.write(f'Error while sending to #{self.channel}: {e!r}\n')
+			try:
+				await self.channel.send(
+					f'An exception occurred when sending this message:\n'
+					f'{str(e)}'
+				)
+			except Exception:
+				pass
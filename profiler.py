@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: Apache-2.0
+# On-demand profiling of the running bot; see the `profile` command.
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+PROFILE_DIR = 'profiles'
+KINDS = ('cpu', 'memory', 'loop')
+MAX_SECONDS = 60
+# Callbacks that block the event loop for longer than this are reported by the `loop` profile.
+SLOW_CALLBACK_SECONDS = 0.05
+
+_running = False
+
+
+async def profile(kind, seconds, top=15):
+	"""
+	Profiles the whole process for `seconds` (capped at MAX_SECONDS) and returns (path, summary),
+	where `path` is the file with the full results and `summary` lists the top entries.
+	Only one profile can run at a time; raises RuntimeError if another one is running.
+	"""
+	global _running
+	if kind not in KINDS:
+		raise ValueError(f'Unknown profile kind: {kind}')
+	if _running:
+		raise RuntimeError('A profile is already running')
+	_running = True
+	try:
+		seconds = max(1, min(seconds, MAX_SECONDS))
+		os.makedirs(PROFILE_DIR, exist_ok=True)
+		path = os.path.join(PROFILE_DIR, f'{kind}-{datetime.now().strftime("%Y%m%d-%H%M%S")}')
+		return await _PROFILERS[kind](seconds, top, path)
+	finally:
+		_running = False
+
+
+async def _cpu(seconds, top, path):
+	profiler = cProfile.Profile()
+	profiler.enable()
+	try:
+		await asyncio.sleep(seconds)
+	finally:
+		profiler.disable()
+	path += '.prof'
+	profiler.dump_stats(path)
+	out = io.StringIO()
+	pstats.Stats(profiler, stream=out).strip_dirs().sort_stats('cumulative').print_stats(top)
+	# Skip pstats' header and keep the table.
+	lines = out.getvalue().strip().splitlines()
+	start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+	return path, '\n'.join(lines[start:])
+
+
+async def _memory(seconds, top, path):
+	already_tracing = tracemalloc.is_tracing()
+	if not already_tracing:
+		tracemalloc.start()
+	try:
+		before = tracemalloc.take_snapshot()
+		await asyncio.sleep(seconds)
+		after = tracemalloc.take_snapshot()
+	finally:
+		if not already_tracing:
+			tracemalloc.stop()
+	stats = after.compare_to(before, 'lineno')
+	path += '.txt'
+	with open(path, 'w') as f:
+		f.writelines(f'{stat}\n' for stat in stats)
+	return path, '\n'.join(str(stat) for stat in stats[:top]) or 'No allocations.'
+
+
+def _callback_name(handle):
+	# What a slow callback is grouped by: the coroutine for steps of a task (whose formatted handle includes the
+	# task's unique name and state), otherwise the function that was called.
+	callback = getattr(handle, '_callback', None)
+	owner = getattr(callback, '__self__', None)
+	if isinstance(owner, asyncio.Task):
+		coro = owner.get_coro()
+		return getattr(coro, '__qualname__', None) or repr(coro)
+	return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+class _SlowCallbackFilter(logging.Filter):
+	# A filter rather than a handler: while a logger has a handler, records it doesn't print aren't printed at all,
+	# and errors like "Task exception was never retrieved" have to keep reaching stderr.
+	def __init__(self, loop):
+		super().__init__()
+		self.loop = loop
+		self.total = defaultdict(float)
+		self.count = defaultdict(int)
+
+	def filter(self, record):
+		# asyncio logs 'Executing %s took %.3f seconds' for slow callbacks in debug mode, while the handle
+		# is still the loop's current one. Those are counted here instead of being printed;
+		# every other record is let through.
+		if not isinstance(record.msg, str) or not isinstance(record.args, tuple):
+			return True
+		if record.msg.startswith('Executing') and len(record.args) == 2:
+			formatted, duration = record.args
+			handle = getattr(self.loop, '_current_handle', None)
+			name = formatted if handle is None else _callback_name(handle)
+			self.total[name] += duration
+			self.count[name] += 1
+			return False
+		return True
+
+
+async def _loop(seconds, top, path):
+	loop = asyncio.get_event_loop()
+	logger = logging.getLogger('asyncio')
+	slow = _SlowCallbackFilter(loop)
+	debug, threshold = loop.get_debug(), loop.slow_callback_duration
+	logger.addFilter(slow)
+	loop.slow_callback_duration = SLOW_CALLBACK_SECONDS
+	loop.set_debug(True)
+	try:
+		await asyncio.sleep(seconds)
+	finally:
+		loop.set_debug(debug)
+		loop.slow_callback_duration = threshold
+		logger.removeFilter(slow)
+	ranked = sorted(slow.total, key=slow.total.get, reverse=True)
+	lines = [f'{slow.total[c]:.3f}s in {slow.count[c]} call(s): {c}' for c in ranked]
+	path += '.txt'
+	with open(path, 'w') as f:
+		f.writelines(f'{line}\n' for line in lines)
+	return path, '\n'.join(lines[:top]) or f'No callbacks took longer than {SLOW_CALLBACK_SECONDS}s.'
+
+
+_PROFILERS = {'cpu': _cpu, 'memory': _memory, 'loop': _loop}
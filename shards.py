@@ -0,0 +1,59 @@
+# SPDX-License-Identifier: Apache-2.0
+# Runs b20q in sharded mode as several processes on this machine, each connecting a contiguous range of shards.
+# Every process only receives events from the guilds on its shards, and all state is stored per guild,
+# so the processes don't need to coordinate. Usage: python shards.py <shard count> [-p processes]
+# The processes share one checkout, so `update` is refused in them; stop this launcher to update instead.
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Discord only lets a bot identify one shard every 5 seconds.
+IDENTIFY_INTERVAL = 5.0
+
+
+def shard_ranges(shards, processes):
+	# Splits range(shards) into `processes` contiguous ranges whose sizes differ by at most one.
+	processes = max(1, min(processes, shards))
+	size, extra = divmod(shards, processes)
+	start = 0
+	for i in range(processes):
+		end = start + size + (i < extra)
+		yield list(range(start, end))
+		start = end
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Run b20q as several shard processes.')
+	parser.add_argument('shards', type=int, help='total number of shards')
+	parser.add_argument(
+		'-p', '--processes', type=int, default=os.cpu_count() or 1, help='number of processes (default: one per core)'
+	)
+	parser.add_argument('--python', default=sys.executable, help='interpreter to run b20q.py with')
+	args = parser.parse_args()
+
+	children = []
+	previous = []  # shard IDs of the last process started
+
+	def stop(signum, frame):
+		for child in children:
+			child.send_signal(signum)
+
+	signal.signal(signal.SIGINT, stop)
+	signal.signal(signal.SIGTERM, stop)
+	for ids in shard_ranges(args.shards, args.processes):
+		if previous:
+			# Let the previous process identify its shards first.
+			time.sleep(IDENTIFY_INTERVAL * len(previous))
+		print(f'Starting shards {ids[0]}-{ids[-1]} of {args.shards}')
+		children.append(subprocess.Popen([args.python, 'b20q.py'], env={
+			**os.environ, 'B20Q_SHARD_COUNT': str(args.shards), 'B20Q_SHARD_IDS': ','.join(map(str, ids))
+		}))
+		previous = ids
+	sys.exit(max(child.wait() for child in children))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: Apache-2.0
+import bisect
+import json
+import itertools
+import os
+import sys
+
+import utils
+
+# Counters kept for every player. Averages are derived from them when asked for.
+FIELDS = (
+	'wins',  # correct guesses, i.e. games won
+	'defended',  # games started as the defender
+	'stumped',  # games defended that ended without a winner
+	'guesses',  # guesses confirmed as correct or incorrect
+	'questions_to_win',  # sum of the questions answered before each win
+	'seconds_to_win',  # sum of the time between the start of the game and each win...
+	'timed_wins'  # ...and the number of wins it covers (games started by older versions aren't timed)
+)
+
+
+def _rank(player):
+	# Leaderboard order: most wins first, then fewest guesses.
+	return -player['wins'], player['guesses']
+
+
+class PlayerStats:
+	"""
+	Statistics of every player in every guild: {guild ID: {user ID: {field: count}}}.
+	The counters are updated as games are played instead of being computed from the history,
+	so looking them up doesn't depend on how many games there have been.
+	Each guild has its own file in `directory`, which is loaded on first use. Changes are written along with
+	the journal entries of the game that made them (see b20qGame._stats_writer), so the two don't drift apart.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+		self.guilds = {}
+		self._dirty = set()
+		self._leaderboards = {}  # guild ID: sorted [(rank, user ID)] of the players with wins
+		self._versions = itertools.count(1)
+		self._writer = utils.VersionedWriter()
+
+	def _path(self, guild_id):
+		return os.path.join(self.directory, f'{guild_id}.stats.json')
+
+	def _guild(self, guild_id):
+		if guild_id not in self.guilds:
+			players = {}
+			try:
+				with open(self._path(guild_id)) as f:
+					players = {int(user): counters for user, counters in json.load(f).items()}
+			except FileNotFoundError:
+				pass
+			except (json.JSONDecodeError, AttributeError, ValueError) as e:
+				sys.stderr.write(f'Error while loading stats from {self._path(guild_id)}: {e!r}\n')
+			self.guilds[guild_id] = players
+		return self.guilds[guild_id]
+
+	def _add(self, guild_id, user_id, **counts):
+		player = self._guild(guild_id).setdefault(user_id, dict.fromkeys(FIELDS, 0))
+		# Only this player moves on the leaderboard, so take them out and put them back in their new place.
+		board = self._leaderboards.get(guild_id)
+		if board is not None and player['wins']:
+			del board[bisect.bisect_left(board, (_rank(player), user_id))]
+		for field, n in counts.items():
+			player[field] = player.get(field, 0) + n
+		if board is not None and player['wins']:
+			bisect.insort(board, (_rank(player), user_id))
+		self._dirty.add(guild_id)
+
+	def started(self, guild_id, defender_id):
+		self._add(guild_id, defender_id, defended=1)
+
+	def guessed(self, guild_id, user_id, correct, questions, seconds=None):
+		# `seconds` is the time since the start of the game, if known.
+		if not correct:
+			self._add(guild_id, user_id, guesses=1)
+		elif seconds is None:
+			self._add(guild_id, user_id, guesses=1, wins=1, questions_to_win=questions)
+		else:
+			self._add(
+				guild_id, user_id, guesses=1, wins=1, questions_to_win=questions, seconds_to_win=seconds, timed_wins=1
+			)
+
+	def ended(self, guild_id, defender_id, winner_id):
+		if winner_id is None:
+			self._add(guild_id, defender_id, stumped=1)
+
+	def get(self, guild_id, user_id):
+		# Returns the player's counters plus the derived averages, or None if they have never played.
+		player = self._guild(guild_id).get(user_id)
+		if player is None:
+			return None
+		player = dict(player)
+		player['accuracy'] = player['wins'] / player['guesses'] if player['guesses'] else None
+		player['average_questions'] = player['questions_to_win'] / player['wins'] if player['wins'] else None
+		player['average_seconds'] = player['seconds_to_win'] / player['timed_wins'] if player['timed_wins'] else None
+		return player
+
+	def leaderboard(self, guild_id, top=None):
+		# The IDs of the `top` (by default, all) players with the most wins, then the fewest guesses.
+		# The guild's board is sorted once and then kept in order by _add().
+		board = self._leaderboards.get(guild_id)
+		if board is None:
+			board = self._leaderboards[guild_id] = sorted(
+				(_rank(player), user) for user, player in self._guild(guild_id).items() if player['wins']
+			)
+		return [user for _, user in board[:top]]
+
+	def take(self, guild_ids=None):
+		# Serializes the guilds (by default, all of them) that changed since the last call, for write().
+		# Must be called from the event loop.
+		guild_ids = self._dirty if guild_ids is None else self._dirty.intersection(guild_ids)
+		taken = [(guild_id, next(self._versions), json.dumps(self.guilds[guild_id])) for guild_id in guild_ids]
+		self._dirty.difference_update(guild_id for guild_id, _, _ in taken)
+		return taken
+
+	def write(self, taken):
+		# Can run in a worker thread.
+		if not taken:
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		for guild_id, version, data in taken:
+			self._writer.write(self._path(guild_id), version, data)
+
+	def save(self):
+		self.write(self.take())
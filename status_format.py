@@ -1,10 +1,9 @@
 # SPDX-License-Identifier: Apache-2.0
 import sys
-from typing import List, Tuple
-from discord import User
+from typing import Callable, Sequence
 
 import b20q
-import commands
+import gamestate
 import utils
 
 # If a message exceeds Discord's length limit, it will be split into chunks that satisfy the limit.
@@ -20,83 +19,189 @@ def breakpoint(end_l='', start_r=''):
 	return BRK1 + end_l + BRK2 + start_r + BRK3
 
 
-def _get_name(user):
+def display_name(user, guild=None):
 	try:
-		return utils.remove_formatting(commands.game.channel.guild.get_member(user.id).display_name)
+		return utils.remove_formatting(guild.get_member(user.id).display_name)
 	except AttributeError:
 		return utils.remove_formatting(user.display_name)
 
 
 def apply(
-	defender,
-	answers: List[Tuple[bool, str]],  # bool: whether it's a yes or a no; str: answer
+	defender,  # user object or None
+	answers: Sequence[gamestate.Answer],
 	max_questions: int,  # -1 for unlimited
-	hints: List[str],
-	guesses: List[Tuple[bool, User, str]],  # bool: whether it's correct; str: user who guessed; str: guess
-	guess_queue: List[Tuple[User, str]],
-	max_guesses: int  # -1 for unlimited
+	hints: Sequence[gamestate.Hint],
+	guesses: Sequence[gamestate.Guess],
+	guess_queue: Sequence[gamestate.QueuedGuess],
+	max_guesses: int,  # -1 for unlimited
+	name: Callable[[int], str]  # returns the display name for a user ID, e.g. b20qGame.display_name
 ):  # so sad
 	# Construct the formatted string here and then return it.
 	# Wherever the `BREAK_POINT` substring (defined at the start of this file) appears,
 	# the message may be broken up into multiple parts if its length exceeds Discord's limit.
-	formatted = ''
+	# StatusRenderer produces the same output, but keeps the sections between calls.
+	return ''.join((
+		_defender_section(defender, name),
+		_answers_section(''.join(_answer_line(i, a) for i, a in enumerate(answers)), not answers),
+		_counters_section(len(answers), max_questions, len(guesses), max_guesses),
+		_hints_section(''.join(_hint_line(i, h) for i, h in enumerate(hints)), not hints),
+		_guesses_section(
+			''.join(_guess_line(i, g, name) for i, g in enumerate(guesses)),
+			''.join(_queued_guess_line(q, name) for q in guess_queue),
+			not (guesses or guess_queue)
+		)
+	))
 
-	# Defender
-	formatted += '```json\n'
-	formatted += 'Defender: '
-	formatted += (f'"{_get_name(defender)} ({defender})"' if defender else 'None (the game is currently not active)')
 
-	# Answers
-	formatted += f'``` {breakpoint()}```diff'
-	if not answers:
-		formatted += '\nNo answers so far.'
-	for i, (correct, answer) in enumerate(answers):
-		formatted += f'\n{"+" if correct else "-"} [{i + 1}] {answer}' + breakpoint('```', '```diff')
+def _defender_section(defender, name):
+	return (
+		'```json\nDefender: ' +
+		(f'"{name(defender.id)} ({defender})"' if defender else 'None (the game is currently not active)')
+	)
 
-	# Questions/guesses left
-	formatted += f'``` {breakpoint()}```py\n'
-	if max_questions == -1:
-		formatted += 'You have unlimited questions.\n'
-	else:
-		formatted += f'Questions answered: {len(answers)}/{max_questions}\n'
-	if max_guesses == -1:
-		formatted += 'You have unlimited guesses.'
-	else:
-		formatted += f'You have {(max_guesses - len(guesses))} guesses left.'
-
-	# Hints
-	formatted += f'``` {breakpoint()}```bat\n'
-	formatted += f'Hints: {"None" if not hints else ""}'
-	for i, hint in enumerate(hints):
-		formatted += f'\n[{i + 1}] {hint}' + breakpoint('```', '```bat')
-
-	# Guesses
-	if guesses or guess_queue:
-		formatted += f'``` {breakpoint()}```diff\n'
-		formatted += 'Guesses:\n'
-		for i, (correct, guesser, guess) in enumerate(guesses):
-			formatted += f'{"+" if correct else "-"} [{i + 1}] {_get_name(guesser)}: {guess}{breakpoint("```", "```diff")}\n'
-		for guesser, guess in guess_queue:
-			formatted += f'? {_get_name(guesser)}: {guess}{breakpoint("```", "```diff")}\n'
-		formatted += '```'
-	else:
-		formatted += f'``` {breakpoint()}```\nNo guesses so far.```'
 
-	return formatted
+def _answer_line(i, answer):
+	return f'\n{"+" if answer.correct else "-"} [{i + 1}] {answer.text}' + breakpoint('```', '```diff')
+
+
+def _answers_section(lines, empty):
+	return f'``` {breakpoint()}```diff' + ('\nNo answers so far.' if empty else '') + lines
+
+
+def _counters_section(answered, max_questions, guessed, max_guesses):
+	return f'``` {breakpoint()}```py\n' + (
+		'You have unlimited questions.\n' if max_questions == -1
+		else f'Questions answered: {answered}/{max_questions}\n'
+	) + (
+		'You have unlimited guesses.' if max_guesses == -1
+		else f'You have {(max_guesses - guessed)} guesses left.'
+	)
+
+
+def _hint_line(i, hint):
+	return f'\n[{i + 1}] {hint.text}' + breakpoint('```', '```bat')
+
+
+def _hints_section(lines, empty):
+	return f'``` {breakpoint()}```bat\nHints: {"None" if empty else ""}' + lines
+
+
+def _guess_line(i, guess, name):
+	return f'{"+" if guess.correct else "-"} [{i + 1}] {name(guess.user_id)}: {guess.text}{breakpoint("```", "```diff")}\n'
+
+
+def _queued_guess_line(queued, name):
+	return f'? {name(queued.user_id)}: {queued.text}{breakpoint("```", "```diff")}\n'
+
+
+def _guesses_section(guess_lines, queue_lines, empty):
+	if empty:
+		return f'``` {breakpoint()}```\nNo guesses so far.```'
+	return f'``` {breakpoint()}```diff\nGuesses:\n' + guess_lines + queue_lines + '```'
+
+
+class StatusRenderer:
+	"""
+	Caches the output of apply() for one game.
+	Lines for answers, hints and guesses are kept between calls; new items at the end of a list are rendered
+	on their own, and anything else only re-renders the sections that the game reports as changed.
+	"""
+	SECTIONS = ('defender', 'answers', 'hints', 'guesses', 'queue')
+
+	def __init__(self, name):
+		self.name = name
+		self._lines = {}
+		self._joined = {}
+		self._defender = None
+		self._rendered = None
+		self._key = None
+		self._fragments = None  # (rendered string, max_length, fragments)
+
+	def invalidate(self, *sections):
+		# Without arguments, everything is rendered from scratch next time.
+		for section in sections or self.SECTIONS:
+			self._lines.pop(section, None)
+			self._joined.pop(section, None)
+		self._rendered = None
+
+	def mutated(self, op, *args):
+		# Called with every journal operation (see journal.apply) applied to the game's status.
+		if op in ('edit', 'delete'):
+			self.invalidate(args[0])
+		elif op in ('queue', 'unqueue', 'clear_queue', 'resolve'):
+			self.invalidate('queue')
+		elif op == 'start':
+			self.invalidate()
+		elif op == 'set' and args[0] == 'defender':
+			self.invalidate('defender')
+		else:
+			self._rendered = None
+
+	def _section_lines(self, section, items, render_line):
+		# Renders the lines for items that were appended since the last call.
+		lines = self._lines.setdefault(section, [])
+		if len(lines) > len(items):
+			lines.clear()
+		if len(lines) < len(items):
+			lines.extend(render_line(i, items[i]) for i in range(len(lines), len(items)))
+			self._joined.pop(section, None)
+		if section not in self._joined:
+			self._joined[section] = ''.join(lines)
+		return self._joined[section]
+
+	def render(self, defender, answers, max_questions, hints, guesses, guess_queue, max_guesses):
+		# Same arguments as apply(), except for `name`, which was given to the constructor.
+		key = (defender, len(answers), max_questions, len(hints), len(guesses), len(guess_queue), max_guesses)
+		if self._rendered is not None and key == self._key:
+			return self._rendered
+		if 'defender' not in self._joined or self._defender != defender:
+			self._defender = defender
+			self._joined['defender'] = _defender_section(defender, self.name)
+		if 'queue' not in self._joined:
+			self._joined['queue'] = ''.join(_queued_guess_line(q, self.name) for q in guess_queue)
+		self._rendered = ''.join((
+			self._joined['defender'],
+			_answers_section(self._section_lines('answers', answers, _answer_line), not answers),
+			_counters_section(len(answers), max_questions, len(guesses), max_guesses),
+			_hints_section(self._section_lines('hints', hints, _hint_line), not hints),
+			_guesses_section(
+				self._section_lines('guesses', guesses, lambda i, g: _guess_line(i, g, self.name)),
+				self._joined['queue'],
+				not (guesses or guess_queue)
+			)
+		))
+		self._key = key
+		return self._rendered
+
+	def fragments(self, max_length, *args):
+		# Yields the output of render(*args) split into messages of at most max_length.
+		# A new render is split as it's yielded, so the first fragment can be sent before the rest exist;
+		# once the last one has been yielded, the fragments are cached along with the rendered string.
+		rendered = self.render(*args)
+		cached = self._fragments
+		if cached is not None and cached[0] is rendered and cached[1] == max_length:
+			yield from cached[2]
+			return
+		collected = []
+		for fragment in collapse_breakpoints(split_breakpoints(rendered), max_length):
+			collected.append(fragment)
+			yield fragment
+		if self._rendered is rendered:
+			self._fragments = (rendered, max_length, collected)
 
 
-async def send(defender, answers, max_questions, hints, guesses, guess_queue, max_guesses, max_length=None):
+async def send(game, defender, answers, max_questions, hints, guesses, guess_queue, max_guesses, max_length=None):
 	max_length = max_length or b20q.MAX_MESSAGE_LENGTH
-	for fragment in collapse_breakpoints(split_breakpoints(apply(
-		defender, answers, max_questions, hints, guesses, guess_queue, max_guesses
-	)), max_length):
-		await commands.game.send(fragment)
+	for fragment in game.renderer.fragments(
+		max_length, defender, answers, max_questions, hints, guesses, guess_queue, max_guesses
+	):
+		await game.send(fragment)
 
 
-async def send_brief(defender, answers, max_questions, hints, guesses, guess_queue, max_guesses):
+async def send_brief(game, defender, answers, max_questions, hints, guesses, guess_queue, max_guesses):
 	formatted = '```json\n'
 	formatted += 'Defender: '
-	formatted += f'"{_get_name(defender)} ({defender})"' if defender else 'None (the game is currently not active)'
+	formatted += f'"{game.display_name(defender.id)} ({defender})"' if defender else 'None (the game is currently not active)'
 	formatted += f'\n'
 	if max_questions == -1:
 		formatted += 'You have unlimited questions.\n'
@@ -110,17 +215,16 @@ async def send_brief(defender, answers, max_questions, hints, guesses, guess_que
 	if guess_queue:
 		formatted += f'; Pending guesses: {len(guess_queue)}'
 	formatted += '```'
-	await commands.game.send(formatted)
+	await game.send(formatted)
 
 
 def split_breakpoints(raw_message):
-	# Splits a message produced by apply() into normal parts and breakpoints.
-	# A normal part will always be followed by a breakpoint unless it's the last element in the list.
-	fragments = []
-	partial_message = raw_message
-	breakpoint_index = partial_message.find(BRK1)
+	# Splits a message produced by apply() into normal parts and breakpoints, yielding them in order.
+	# A normal part will always be followed by a breakpoint unless it's the last element.
+	start = 0
+	breakpoint_index = raw_message.find(BRK1)
 	while breakpoint_index != -1:
-		end_index = partial_message.find(BRK3)
+		end_index = raw_message.find(BRK3, breakpoint_index)
 		if end_index == -1:
 			raise ValueError(
 				f'Problematic format string:\n\n{raw_message}\n\n'
@@ -128,33 +232,38 @@ def split_breakpoints(raw_message):
 				f'\t| {raw_message[breakpoint_index-10:breakpoint_index+10]}\n'
 				f'\t|           ^^^'
 			)
-		fragments.append(partial_message[:breakpoint_index])
-		fragments.append(partial_message[breakpoint_index:end_index+1])
-		partial_message = partial_message[end_index+1:]
-		breakpoint_index = partial_message.find(BRK1)
-	fragments.append(partial_message)
-	return fragments
+		yield raw_message[start:breakpoint_index]
+		yield raw_message[breakpoint_index:end_index+1]
+		start = end_index + 1
+		breakpoint_index = raw_message.find(BRK1, start)
+	yield raw_message[start:]
 
 
 def collapse_breakpoints(split_list, max_length):
-	# Takes the result of split_breakpoints() and produces a list of fragments to be sent according to max_length.
-	fragments = [split_list.pop(0)]
-	uncollapsed = split_list
-	while len(uncollapsed) > 1:
-		# Here, uncollapsed is guaranteed to start with a breakpoint and have a normal part immediately after
-		if uncollapsed[0].count(BRK2) != 1:
+	# Takes the result of split_breakpoints() and yields fragments to be sent according to max_length.
+	# Each fragment is yielded as soon as it's complete, so only one is held in memory at a time.
+	split_list = iter(split_list)
+	fragment = [next(split_list)]
+	length = len(fragment[0])
+	for brk in split_list:
+		part_r = next(split_list, None)
+		if part_r is None:
+			break
+		# Here, brk is guaranteed to be a breakpoint and part_r the normal part immediately after it
+		if brk.count(BRK2) != 1:
 			raise ValueError(
-				f'Problematic format string:\n\n{"".join(split_list)}\n\n'
+				f'Problematic format string:\n\n'
 				f'Expected exactly one BRK2 between BRK1 and BRK3 in the following part:\n'
-				f'\t| {fragments[-1][:-10]}'
-				f'{uncollapsed[0].replace(BRK1, "{BRK1}").replace(BRK2, "{BRK2}").replace(BRK3, "{BRK3}")}'
+				f'\t| {"".join(fragment)[-10:]}'
+				f'{brk.replace(BRK1, "{BRK1}").replace(BRK2, "{BRK2}").replace(BRK3, "{BRK3}")}'
 			)
-		part_l = fragments[-1]
-		end_l, start_r = uncollapsed.pop(0).lstrip(BRK1).rstrip(BRK3).split(BRK2)
-		part_r = uncollapsed.pop(0)
-		if len(part_l) + len(part_r) > max_length:
-			fragments[-1] += end_l
-			fragments.append(start_r + part_r)
+		end_l, start_r = brk[len(BRK1):-len(BRK3)].split(BRK2)
+		if length + len(part_r) > max_length:
+			fragment.append(end_l)
+			yield ''.join(fragment)
+			fragment = [start_r, part_r]
+			length = len(start_r) + len(part_r)
 		else:
-			fragments[-1] += part_r
-	return fragments
+			fragment.append(part_r)
+			length += len(part_r)
+	yield ''.join(fragment)
@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: Apache-2.0
+import asyncio
+import json
+import sys
+
+import discord
+
+import utils
+
+# Maximum number of fetch_user requests that may be in flight at once.
+MAX_CONCURRENT_FETCHES = 8
+
+
+class Placeholder(discord.User):
+	# Stands in for a user that can't be found (yet). Never remembered, so that they're looked up again later.
+	__slots__ = ()
+
+
+def placeholder(user_id):
+	return Placeholder(state=None, data={
+		'id': user_id, 'username': f'Unknown user {user_id}', 'discriminator': '0', 'avatar': None
+	})
+
+
+class UserCache:
+	# Persistent {user ID: user data} for everyone who has taken part in a game, so that games can be loaded
+	# without asking Discord about every single guesser. The data is in the same format as Discord's API uses.
+	def __init__(self, path='users.json'):
+		self.path = path
+		self.records = {}
+		self.dirty = False
+		self._version = 0
+		self._writer = utils.VersionedWriter()
+		try:
+			with open(self.path) as f:
+				self.records = {int(i): r for i, r in json.load(f).items()}
+		except FileNotFoundError:
+			pass
+		except (json.JSONDecodeError, AttributeError, ValueError) as e:
+			sys.stderr.write(f'Error while loading the user cache from {self.path}: {e!r}\n')
+
+	def remember(self, user):
+		if isinstance(user, Placeholder):
+			return
+		record = {
+			'id': user.id,
+			'username': user.name,
+			'discriminator': user.discriminator,
+			'global_name': getattr(user, 'global_name', None),
+			'avatar': None,
+			'bot': user.bot
+		}
+		if self.records.get(user.id) != record:
+			self.records[user.id] = record
+			self.dirty = True
+
+	def take(self):
+		# Serializes the records if they changed since the last call, for write(). Must be called from the event loop.
+		if not self.dirty:
+			return None
+		self.dirty = False
+		self._version += 1
+		return self._version, json.dumps(self.records)
+
+	def write(self, taken):
+		# Can run in a worker thread.
+		if taken is not None:
+			self._writer.write(self.path, *taken)
+
+	def save(self):
+		self.write(self.take())
+
+	def lookup(self, client, user_id):
+		# Returns the user from the client's cache or this one, or None if neither knows them. Never waits.
+		user = client.get_user(user_id)
+		if user is None and user_id in self.records:
+			user = discord.User(state=client._connection, data=self.records[user_id])
+		return user
+
+	async def resolve(self, client, ids):
+		"""
+		Returns {user ID: user object or None} for the given IDs. Duplicates are only looked up once.
+		Users are taken from the client's cache if possible, then from this cache,
+		and only fetched from Discord (with limited concurrency) if neither knows them.
+		"""
+		semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+		async def _resolve(i):
+			user = self.lookup(client, i)
+			if user is None:
+				async with semaphore:
+					try:
+						user = await client.fetch_user(i)
+					except discord.NotFound:
+						return None
+					except discord.HTTPException as e:
+						sys.stderr.write(f'Error while fetching user ID {i}: {e!r}\n')
+						return None
+			if user is not None:
+				self.remember(user)
+			return user
+
+		ids = list(set(ids))
+		return dict(zip(ids, await asyncio.gather(*map(_resolve, ids))))
@@ -1,28 +1,64 @@
+import os
 import re
+import threading
 
 
 async def noop():
 	pass
 
 
-def remove_formatting(text):
-	re_strip = (
-		(r'(\*{1,3})(.+?)\1', '*'),
-		(r'(\_{1,3})(.+?)\1', '_'),
-		(r'```([^`]+?)```', '```'),
-		(r'`([^`\r\n]+?)`', '`')
-	)
-	re_strip_one = (
-		(r'(\~\~)(.+?)\1', '~~'),
-		(r'(\|\|)(.+?)\1', '||')
+def write_atomic(path, data, sync=False):
+	# Writes to a temporary file next to `path` and then replaces it, so that a crash never leaves a partial file.
+	# With sync=True, the data is on disk before the file is replaced.
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		f.write(data)
+		if sync:
+			f.flush()
+			os.fsync(f.fileno())
+	os.replace(tmp, path)
+
+
+class VersionedWriter:
+	# Writes files with write_atomic() from any thread. Data is serialized on the event loop with a version number
+	# that increases each time, and a version older than the one already written to the same path is skipped.
+	def __init__(self):
+		self._written = {}  # path: version
+		self._lock = threading.Lock()
+
+	def write(self, path, version, data):
+		with self._lock:
+			if version <= self._written.get(path, 0):
+				return
+			write_atomic(path, data)
+			self._written[path] = version
+
+
+# Alternatives are tried left to right at each position, so code takes priority over everything else.
+_FORMATTING = re.compile(
+	r'```(?:\w+(?=\n))?(?P<block>[^`]+?)```'  # code block, optionally language-tagged
+	r'|```\w+$'  # language tag of a code block that is never closed
+	r'|`(?P<code>[^`\r\n]+?)`'  # inline code
+	r'|(?P<stars>\*{1,3})(?P<starred>.+?)(?P=stars)'  # italics, bold
+	r'|(?P<underscores>_{1,3})(?P<underscored>.+?)(?P=underscores)'  # italics, underline
+	r'|~~(?P<strikethrough>.+?)~~'
+	r'|\|\|(?P<spoiler>.+?)\|\|',
+	re.M
+)
+
+
+def _strip_match(match):
+	code = match.group('block') or match.group('code')
+	if code is not None:
+		# Discord doesn't apply formatting inside code, so neither do we.
+		return code
+	inner = (
+		match.group('starred') or match.group('underscored') or
+		match.group('strikethrough') or match.group('spoiler')
 	)
-	re_special_code_block = r'```\w+$'
-
-	text = re.sub(re_special_code_block, '', text, flags=re.M)
-	for regex, char in re_strip:
-		for match in re.finditer(regex, text):
-			text = text.replace(match.group(), match.group().strip(char))
-	for regex, substr in re_strip_one:
-		for match in re.finditer(regex, text):
-			text = text.replace(match.group(), match.group()[len(substr):-len(substr)])
-	return text
+	return '' if inner is None else remove_formatting(inner)
+
+
+def remove_formatting(text):
+	# Removes Discord's markdown in one pass over the text; nested formatting is handled recursively.
+	return _FORMATTING.sub(_strip_match, text)